@@ -0,0 +1,196 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from typing import Callable, Dict, List
+# Micro-benchmarks for the per-event contest hot paths. Runs entirely offline
+# against synthetic state in a temporary directory:
+#   python bench.py --out bench_results.json
+#   python bench.py --quick --compare bench_results.json
+PARTICIPANT_SIZES = [10, 1000, 100000, 1000000]
+CHAT_SIZES = [1, 100, 10000]
+QUICK_PARTICIPANT_SIZES = [10, 1000, 10000]
+QUICK_CHAT_SIZES = [1, 100]
+PARTICIPANTS_PER_CHAT = 100
+def run_sync(coro):
+    # the render path never actually suspends, so drive it without a loop
+    try:
+        coro.send(None)
+    except StopIteration as stop:
+        return stop.value
+    raise RuntimeError("coroutine suspended")
+def percentile(samples: List[int], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+def measure(fn: Callable[[], object], budget: float, max_iterations: int) -> Dict:
+    samples = []
+    started = time.perf_counter()
+    while len(samples) < max_iterations:
+        t0 = time.perf_counter_ns()
+        fn()
+        samples.append(time.perf_counter_ns() - t0)
+        if len(samples) >= 5 and time.perf_counter() - started >= budget:
+            break
+    total = sum(samples) / 1e9
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    fn()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return {
+        "iterations": len(samples),
+        "ops_per_sec": round(len(samples) / total, 1) if total else None,
+        "p50_us": round(percentile(samples, 0.50) / 1e3, 2),
+        "p99_us": round(percentile(samples, 0.99) / 1e3, 2),
+        "peak_kib": round(max(0, peak) / 1024, 1),
+    }
+def synthetic_state(chats: int, participants: int, rng: random.Random) -> Dict:
+    state = {}
+    end_ts = int(time.time()) + 7 * 86400
+    for c in range(chats):
+        scores = {str(1_000_000_000 + u): rng.randint(1, 50) for u in range(participants)}
+        state[str(-1001000000000 - c)] = {
+            "active": True,
+            "end_ts": end_ts,
+            "scores": scores,
+            "pinned_message_id": 1,
+            "links": {},
+        }
+    return state
+def install_state(bot, state: Dict):
+    bot.STATE.clear()
+    for key, cs in state.items():
+        cs["scores"] = bot.ScoreTable.from_json(cs["scores"])
+        bot.STATE[key] = cs
+    bot.RANKS.clear()
+def bench_case(bot, chats: int, participants: int, args, rng: random.Random) -> List[Dict]:
+    state = synthetic_state(chats, participants, rng)
+    install_state(bot, state)
+    chat_keys = list(state)
+    chat_id = int(chat_keys[0])
+    end_ts = state[chat_keys[0]]["end_ts"]
+    user_ids = [1_000_000_000 + rng.randrange(participants * 2) for _ in range(4096)]
+    counter = iter(range(1 << 62))
+    def credit():
+        bot.credit_invite(chat_id, user_ids[next(counter) & 4095])
+    bot.get_rank_index(chat_id)
+    def render():
+        run_sync(bot.render_leaderboard_text(chat_id))
+    def time_left():
+        bot.time_left_str(end_ts)
+    def top3():
+        bot.get_rank_index(chat_id).top(3)
+    def rank_rebuild():
+        bot.RankIndex(bot.STATE[chat_keys[0]]["scores"])
+    def legacy_sort():
+        scores = bot.STATE[chat_keys[0]]["scores"]
+        sorted(scores.items(), key=lambda kv: (-kv[1], int(kv[0])))[:20]
+    loop = asyncio.new_event_loop()
+    def flush_one_dirty():
+        bot.mark_dirty(chat_id)
+        loop.run_until_complete(bot.flush_state())
+    def flush_all_dirty():
+        for key in chat_keys:
+            bot.mark_dirty(key)
+        loop.run_until_complete(bot.flush_state())
+    def save_full():
+        bot.save_state(bot.STATE)
+    def load_full():
+        storage = bot.JsonStorage(bot.STATE_FILE, bot.EVENT_LOG_FILE)
+        storage.load_chats()
+        storage.close()
+    ops = [
+        ("credit_invite", credit, 20000),
+        ("render_leaderboard_text", render, 5000),
+        ("time_left_str", time_left, 20000),
+        ("end_contest_top3", top3, 20000),
+        ("rank_index_rebuild", rank_rebuild, 50),
+        ("legacy_sort_top20", legacy_sort, 50),
+        ("flush_state_one_dirty", flush_one_dirty, 200),
+        ("flush_state_all_dirty", flush_all_dirty, 20),
+        ("save_state", save_full, 20),
+        ("load_state", load_full, 20),
+    ]
+    results = []
+    for name, fn, max_iterations in ops:
+        if args.only and name not in args.only:
+            continue
+        result = measure(fn, args.budget, max_iterations)
+        result.update({"op": name, "chats": chats, "participants": participants})
+        results.append(result)
+        print(
+            f"{name:<26} chats={chats:<6} participants={participants:<8} "
+            f"{result['ops_per_sec'] or 0:>12.1f} ops/s  p50={result['p50_us']:>10.2f}us  "
+            f"p99={result['p99_us']:>10.2f}us  peak={result['peak_kib']:>9.1f}KiB",
+            flush=True,
+        )
+    loop.close()
+    return results
+def compare(results: List[Dict], baseline_path: str, tolerance: float) -> int:
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    old = {(r["op"], r["chats"], r["participants"]): r for r in baseline["results"]}
+    regressions = 0
+    for r in results:
+        prev = old.get((r["op"], r["chats"], r["participants"]))
+        if not prev or not prev["p50_us"]:
+            continue
+        change = (r["p50_us"] - prev["p50_us"]) / prev["p50_us"]
+        if change > tolerance:
+            regressions += 1
+            print(
+                f"REGRESSION {r['op']} chats={r['chats']} participants={r['participants']}: "
+                f"p50 {prev['p50_us']}us -> {r['p50_us']}us ({change:+.0%})"
+            )
+    return regressions
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the contest hot paths on synthetic state.")
+    parser.add_argument("--out", default="bench_results.json", help="where to write JSON results")
+    parser.add_argument("--quick", action="store_true", help="smaller sizes for CI smoke runs")
+    parser.add_argument("--budget", type=float, default=0.5, help="seconds spent timing each op")
+    parser.add_argument("--only", nargs="*", help="restrict to these op names")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--compare", help="baseline JSON to compare p50 latencies against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 slowdown before failing")
+    args = parser.parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="contest-bench-")
+    # main loads state at import time, so point it at the scratch dir first
+    os.environ["STATE_FILE"] = os.path.join(workdir, "contest_state.json")
+    os.environ["EVENT_LOG_FILE"] = os.path.join(workdir, "contest_events.log")
+    os.environ["STORAGE_BACKEND"] = "json"
+    import main as bot
+    rng = random.Random(args.seed)
+    participant_sizes = QUICK_PARTICIPANT_SIZES if args.quick else PARTICIPANT_SIZES
+    chat_sizes = QUICK_CHAT_SIZES if args.quick else CHAT_SIZES
+    results = []
+    for participants in participant_sizes:
+        results += bench_case(bot, 1, participants, args, rng)
+    for chats in chat_sizes:
+        if chats > 1:
+            results += bench_case(bot, chats, PARTICIPANTS_PER_CHAT, args, rng)
+    report = {
+        "meta": {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "timestamp": int(time.time()),
+            "quick": args.quick,
+        },
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    shutil.rmtree(workdir, ignore_errors=True)
+    print(f"wrote {len(results)} results to {args.out}")
+    if args.compare:
+        return 1 if compare(results, args.compare, args.tolerance) else 0
+    return 0
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
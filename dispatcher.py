@@ -0,0 +1,184 @@
+import time
+import asyncio
+import itertools
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from telegram.error import RetryAfter
+from metrics import API_CALLS, API_SECONDS
+PRIORITY_ANNOUNCE = 0
+PRIORITY_REPLY = 1
+PRIORITY_LEADERBOARD = 2
+PRIORITY_CLEANUP = 3
+PRIORITY_NAMES = {
+    PRIORITY_ANNOUNCE: "announce",
+    PRIORITY_REPLY: "reply",
+    PRIORITY_LEADERBOARD: "leaderboard",
+    PRIORITY_CLEANUP: "cleanup",
+}
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    def delay(self) -> float:
+        # seconds until a token is available, without taking it
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+    def reserve(self) -> float:
+        # take a token now and return how long to wait before using it
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 0:
+            wait = max(wait, -self.tokens / self.rate)
+        return wait
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+    def idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+class ApiCall:
+    __slots__ = ("priority", "seq", "chat_id", "method", "args", "kwargs", "future")
+    def __init__(self, priority, seq, chat_id, method, args, kwargs, future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+    def __lt__(self, other: "ApiCall") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+def _consume_exception(future: asyncio.Future):
+    if not future.cancelled():
+        future.exception()
+class ApiDispatcher:
+    # Every outbound Bot API call goes through one priority queue. Workers take
+    # the most important call whose chat has a token in its bucket, then wait
+    # on the global bucket. Calls for a throttled chat are parked with
+    # call_later instead of blocking a worker, and RetryAfter pauses that
+    # chat's bucket and re-queues the call rather than dropping it.
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        chat_burst: float = 5.0,
+        workers: int = 8,
+        max_chat_buckets: int = 10000,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets: Dict[Any, TokenBucket] = {}
+        self.max_chat_buckets = max_chat_buckets
+        self.worker_count = workers
+        self.workers: List[asyncio.Task] = []
+        self.queue: Optional[asyncio.PriorityQueue] = None
+        self.seq = itertools.count()
+        self.pending = {priority: 0 for priority in PRIORITY_NAMES}
+        self.parked = 0
+        self.counters = {"calls": 0, "errors": 0, "retry_after": 0}
+        self.chat_calls: Dict[Any, int] = {}
+    def start(self):
+        if self.workers:
+            return
+        self.queue = asyncio.PriorityQueue()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+    async def stop(self):
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.max_chat_buckets:
+                for key in [k for k, b in self.chat_buckets.items() if b.idle()]:
+                    del self.chat_buckets[key]
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+    def submit(self, priority: int, chat_id, method: Callable[..., Awaitable], /, *args, **kwargs) -> asyncio.Future:
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        call = ApiCall(priority, next(self.seq), chat_id, method, args, kwargs, future)
+        self.pending[priority] += 1
+        self.queue.put_nowait(call)
+        return future
+    async def call(self, priority: int, chat_id, method: Callable[..., Awaitable], /, *args, **kwargs):
+        return await self.submit(priority, chat_id, method, *args, **kwargs)
+    def _park(self, call: ApiCall, delay: float):
+        self.parked += 1
+        asyncio.get_running_loop().call_later(delay, self._unpark, call)
+    def _unpark(self, call: ApiCall):
+        self.parked -= 1
+        self.queue.put_nowait(call)
+    async def _worker(self):
+        while True:
+            call = await self.queue.get()
+            if call.future.done():
+                self.pending[call.priority] -= 1
+                continue
+            bucket = self._chat_bucket(call.chat_id) if call.chat_id is not None else None
+            if bucket is not None:
+                wait = bucket.delay()
+                if wait > 0:
+                    self._park(call, wait)
+                    continue
+                bucket.reserve()
+            wait = self.global_bucket.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            name = getattr(call.method, "__name__", "unknown")
+            if call.chat_id is not None:
+                self.chat_calls[call.chat_id] = self.chat_calls.get(call.chat_id, 0) + 1
+            started = time.monotonic()
+            try:
+                result = await call.method(*call.args, **call.kwargs)
+            except RetryAfter as e:
+                API_CALLS.inc(name, "RetryAfter")
+                retry_after = e.retry_after
+                if not isinstance(retry_after, (int, float)):
+                    retry_after = retry_after.total_seconds()
+                self.counters["retry_after"] += 1
+                if bucket is not None:
+                    bucket.block(retry_after)
+                else:
+                    self.global_bucket.block(retry_after)
+                self._park(call, retry_after)
+                continue
+            except asyncio.CancelledError:
+                self.pending[call.priority] -= 1
+                call.future.cancel()
+                raise
+            except Exception as e:
+                API_CALLS.inc(name, type(e).__name__)
+                API_SECONDS.observe(name, value=time.monotonic() - started)
+                self.counters["errors"] += 1
+                self.pending[call.priority] -= 1
+                if not call.future.done():
+                    call.future.set_exception(e)
+                continue
+            API_CALLS.inc(name, "ok")
+            API_SECONDS.observe(name, value=time.monotonic() - started)
+            self.counters["calls"] += 1
+            self.pending[call.priority] -= 1
+            if not call.future.done():
+                call.future.set_result(result)
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": {PRIORITY_NAMES[p]: n for p, n in self.pending.items()},
+            "parked": self.parked,
+            "chat_buckets": len(self.chat_buckets),
+            **self.counters,
+        }
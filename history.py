@@ -0,0 +1,98 @@
+import os
+import csv
+import sys
+import glob
+import json
+import argparse
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+from dotenv import load_dotenv
+from storage import DAY, HOUR, JsonStorage, SqliteStorage
+# Queries over the contest archive. Every archived contest carries its joins
+# already rolled up per hour and per day, so a report only sums a few hundred
+# buckets per contest instead of replaying credit events. Also an export tool:
+#   python history.py --since 2026-09-01 --bucket hour --format csv
+#   python history.py --chat -1001234567890 --bucket contest --format json
+load_dotenv()
+STATE_FILE = os.getenv("STATE_FILE", "contest_state.json")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+DB_FILE = os.getenv("DB_FILE", "contest_state.db")
+BUCKETS = {"hour": HOUR, "day": DAY}
+def joins_by_bucket(records: Iterable[Dict], bucket: int = HOUR, since: int = 0, until: Optional[int] = None) -> List[Tuple[int, int]]:
+    # (bucket start, joins) summed over the given contests, oldest first
+    totals: Dict[int, int] = {}
+    for record in records:
+        for ts, joins in record.get("daily" if bucket == DAY else "hourly", ()):
+            if ts >= since and (until is None or ts < until):
+                totals[ts] = totals.get(ts, 0) + joins
+    return sorted(totals.items())
+def busiest(buckets: List[Tuple[int, int]]) -> Optional[Tuple[int, int]]:
+    return max(buckets, key=lambda b: (b[1], -b[0])) if buckets else None
+def contest_row(record: Dict) -> Dict:
+    top = record.get("top") or [[None, None]]
+    return {
+        "chat": record["chat"],
+        "start": iso(record.get("start_ts")),
+        "end": iso(record["end_ts"]),
+        "participants": record.get("participants"),
+        "joins": record.get("joins"),
+        "links": record.get("links"),
+        "revoked": record.get("revoked"),
+        "top_user": top[0][0],
+        "top_score": top[0][1],
+    }
+def iso(ts: Optional[int]) -> Optional[str]:
+    if not ts:
+        return None
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+def parse_date(value: str) -> int:
+    return int(datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp())
+def archived_contests(chat_id=None, since: int = 0) -> List[Dict]:
+    if STORAGE_BACKEND == "sqlite":
+        storage = SqliteStorage(DB_FILE)
+        try:
+            return storage.archived_contests(chat_id, since)
+        finally:
+            storage.close()
+    # a sharded deployment keeps one snapshot, and so one archive, per worker
+    root, ext = os.path.splitext(STATE_FILE)
+    records = []
+    for path in [STATE_FILE] + sorted(glob.glob(f"{glob.escape(root)}.shard*{ext}")):
+        records += JsonStorage(path, os.devnull).archived_contests(chat_id, since)
+    return sorted(records, key=lambda r: r["end_ts"])
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Export archived contests and their join rollups.")
+    parser.add_argument("--chat", type=int, help="only this chat")
+    parser.add_argument("--since", type=parse_date, default=0, help="UTC date, e.g. 2026-09-01")
+    parser.add_argument("--until", type=parse_date, help="UTC date, exclusive")
+    parser.add_argument("--bucket", choices=["hour", "day", "contest"], default="day")
+    parser.add_argument("--format", choices=["csv", "json"], default="csv")
+    parser.add_argument("--out", help="write here instead of stdout")
+    args = parser.parse_args(argv)
+    # contests that ended before the window cannot have joins inside it
+    records = [
+        r for r in archived_contests(args.chat, args.since)
+        if args.until is None or (r.get("start_ts") or r["end_ts"]) < args.until
+    ]
+    if args.bucket == "contest":
+        rows = [contest_row(r) for r in records]
+    else:
+        rows = [
+            {args.bucket: iso(ts), "joins": joins}
+            for ts, joins in joins_by_bucket(records, BUCKETS[args.bucket], args.since, args.until)
+        ]
+    out = open(args.out, "w", encoding="utf-8", newline="") if args.out else sys.stdout
+    try:
+        if args.format == "json":
+            json.dump(rows, out, ensure_ascii=False, indent=2)
+            out.write("\n")
+        elif rows:
+            writer = csv.DictWriter(out, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    finally:
+        if args.out:
+            out.close()
+    return 0
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
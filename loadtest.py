@@ -0,0 +1,265 @@
+import os
+import sys
+import json
+import time
+import random
+import signal
+import asyncio
+import argparse
+import tempfile
+from urllib.parse import parse_qs
+from typing import Dict, List, Optional
+# End-to-end load test: serves a local stand-in for the Bot API, runs the real
+# main.py against it as a subprocess (BOT_API_BASE_URL), replays a scripted
+# join storm across many chats and reports latency, call volume and errors.
+#   python loadtest.py --chats 50 --joins 2000 --rate 500 --latency-ms 30 --error-rate 0.02
+FAKE_TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Loadtest", "username": "loadtest_bot"}
+ADMIN_ID = 1
+POLL_METHODS = {"getMe", "getUpdates", "deleteWebhook", "setWebhook", "getWebhookInfo", "close", "logOut"}
+LEADERBOARD_METHODS = {"editMessageText", "sendMessage"}
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct))], 4)
+class FakeBotApi:
+    def __init__(self, latency: float, jitter: float, error_rate: float, retry_after: int, rng: random.Random):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.rng = rng
+        self.updates: List[Dict] = []
+        self.update_event = asyncio.Event()
+        self.next_message_id = 1_000_000
+        self.calls: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.pending_joins: Dict[int, List[float]] = {}
+        self.join_latencies: List[float] = []
+        self.last_call = time.monotonic()
+    def push_update(self, update: Dict):
+        self.updates.append(update)
+        self.update_event.set()
+        msg = update.get("message") or {}
+        if msg.get("new_chat_members"):
+            self.pending_joins.setdefault(msg["chat"]["id"], []).append(time.monotonic())
+    async def handle(self, method: str, params: Dict):
+        if method == "getUpdates":
+            return await self.get_updates(params)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method not in POLL_METHODS:
+            self.last_call = time.monotonic()
+            await asyncio.sleep(max(0.0, self.rng.gauss(self.latency, self.jitter)))
+            if self.rng.random() < self.error_rate:
+                self.errors[method] = self.errors.get(method, 0) + 1
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+        chat_id = params.get("chat_id")
+        if method in LEADERBOARD_METHODS and chat_id in self.pending_joins:
+            now = time.monotonic()
+            self.join_latencies.extend(now - ts for ts in self.pending_joins.pop(chat_id))
+        if method == "getMe":
+            return 200, {"ok": True, "result": BOT_USER}
+        if method in ("sendMessage", "editMessageText"):
+            self.next_message_id += 1
+            message = {
+                "message_id": params.get("message_id") or self.next_message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": f"chat {chat_id}"},
+                "from": BOT_USER,
+                "text": str(params.get("text", "")),
+            }
+            return 200, {"ok": True, "result": message}
+        if method == "getChatMember":
+            return 200, {"ok": True, "result": self.member(params.get("user_id"))}
+        if method == "getChatAdministrators":
+            return 200, {"ok": True, "result": [self.member(ADMIN_ID)]}
+        if method in ("createChatInviteLink", "revokeChatInviteLink"):
+            link = params.get("invite_link") or f"https://t.me/+loadtest{self.next_message_id}"
+            self.next_message_id += 1
+            result = {
+                "invite_link": link,
+                "creator": BOT_USER,
+                "creates_join_request": False,
+                "is_primary": False,
+                "is_revoked": method == "revokeChatInviteLink",
+            }
+            return 200, {"ok": True, "result": result}
+        return 200, {"ok": True, "result": True}
+    def member(self, user_id) -> Dict:
+        status = "administrator" if user_id == ADMIN_ID else "member"
+        member = {"user": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}, "status": status}
+        if status == "administrator":
+            member.update({
+                "can_be_edited": False, "is_anonymous": False, "can_manage_chat": True,
+                "can_delete_messages": True, "can_manage_video_chats": True,
+                "can_restrict_members": True, "can_promote_members": True,
+                "can_change_info": True, "can_invite_users": True,
+                "can_post_stories": True, "can_edit_stories": True, "can_delete_stories": True,
+            })
+        return member
+    async def get_updates(self, params: Dict):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        if offset:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self.update_event.clear()
+            try:
+                await asyncio.wait_for(self.update_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return 200, {"ok": True, "result": self.updates[:limit]}
+    async def serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                path = request_line.split()[1].decode()
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode().partition(":")
+                    if name.strip().lower() == "content-length":
+                        length = int(value.strip())
+                body = await reader.readexactly(length) if length else b""
+                params = {}
+                for key, values in parse_qs(body.decode()).items():
+                    try:
+                        params[key] = json.loads(values[0])
+                    except ValueError:
+                        params[key] = values[0]
+                status, payload = await self.handle(path.rstrip("/").rsplit("/", 1)[-1], params)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # connection reset, or a long poll still open when the run shuts down
+            pass
+        finally:
+            writer.close()
+def join_update(update_id: int, chat_id: int, inviter_id: int, member_id: int) -> Dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"chat {chat_id}"},
+            "from": {"id": inviter_id, "is_bot": False, "first_name": f"user{inviter_id}"},
+            "new_chat_members": [{"id": member_id, "is_bot": False, "first_name": f"user{member_id}"}],
+        },
+    }
+def command_update(update_id: int, chat_id: int, command: str) -> Dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"chat {chat_id}"},
+            "from": {"id": ADMIN_ID, "is_bot": False, "first_name": "admin"},
+            "text": command,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }
+async def run(args) -> Dict:
+    rng = random.Random(args.seed)
+    api = FakeBotApi(args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate, args.retry_after, rng)
+    server = await asyncio.start_server(api.serve_connection, "127.0.0.1", args.port)
+    port = server.sockets[0].getsockname()[1]
+    workdir = tempfile.mkdtemp(prefix="contest-loadtest-")
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": FAKE_TOKEN,
+        "BOT_API_BASE_URL": f"http://127.0.0.1:{port}/bot",
+        "BOT_MODE": "polling",
+        "STATE_FILE": os.path.join(workdir, "contest_state.json"),
+        "EVENT_LOG_FILE": os.path.join(workdir, "contest_events.log"),
+        "DB_FILE": os.path.join(workdir, "contest_state.db"),
+    })
+    main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    bot = await asyncio.create_subprocess_exec(sys.executable, main_py, env=env, cwd=workdir)
+    chats = [-1002000000000 - i for i in range(args.chats)]
+    update_id = 1
+    for chat_id in chats:
+        api.push_update(command_update(update_id, chat_id, "/konkurs"))
+        update_id += 1
+    await asyncio.sleep(args.warmup)
+    started = time.monotonic()
+    for n in range(args.joins):
+        chat_id = rng.choice(chats)
+        inviter = 10_000 + rng.randrange(args.inviters)
+        api.push_update(join_update(update_id, chat_id, inviter, 50_000_000 + n))
+        update_id += 1
+        # pace to the requested rate without sleeping for every single update
+        ahead = (n + 1) / args.rate - (time.monotonic() - started)
+        if ahead > 0.005:
+            await asyncio.sleep(ahead)
+    storm_seconds = time.monotonic() - started
+    deadline = time.monotonic() + args.drain
+    while time.monotonic() < deadline and (api.pending_joins or time.monotonic() - api.last_call < args.idle):
+        await asyncio.sleep(0.1)
+    bot.send_signal(signal.SIGINT)
+    try:
+        await asyncio.wait_for(bot.wait(), 30)
+    except asyncio.TimeoutError:
+        bot.kill()
+    server.close()
+    await server.wait_closed()
+    api_calls = sum(n for m, n in api.calls.items() if m not in POLL_METHODS)
+    errors = sum(api.errors.values())
+    return {
+        "config": vars(args),
+        "storm_seconds": round(storm_seconds, 3),
+        "joins": args.joins,
+        "joins_reflected": len(api.join_latencies),
+        "join_to_edit_latency_s": {
+            "p50": percentile(api.join_latencies, 0.50),
+            "p90": percentile(api.join_latencies, 0.90),
+            "p99": percentile(api.join_latencies, 0.99),
+            "max": percentile(api.join_latencies, 1.0),
+        },
+        "api_calls": api_calls,
+        "api_calls_per_join": round(api_calls / args.joins, 4) if args.joins else None,
+        "calls_by_method": dict(sorted(api.calls.items())),
+        "injected_429": errors,
+        "error_rate": round(errors / api_calls, 4) if api_calls else 0.0,
+        "bot_exit_code": bot.returncode,
+    }
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Replay a join storm against main.py and a local fake Bot API.")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--joins", type=int, default=1000)
+    parser.add_argument("--inviters", type=int, default=200, help="distinct inviting users")
+    parser.add_argument("--rate", type=float, default=200.0, help="join updates per second")
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--warmup", type=float, default=3.0, help="seconds to let contests start")
+    parser.add_argument("--drain", type=float, default=60.0, help="max seconds to wait after the storm")
+    parser.add_argument("--idle", type=float, default=5.0, help="stop after this many quiet seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="write the JSON report here as well")
+    args = parser.parse_args(argv)
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    return 0
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
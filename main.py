@@ -1,410 +1,1087 @@
-import os
-import json
-from datetime import datetime, timedelta, timezone
-from typing import Dict
-from dotenv import load_dotenv
-from telegram import Update, ChatMember
-from telegram.constants import ParseMode
-from telegram.ext import (
-    ApplicationBuilder,
-    CommandHandler,
-    MessageHandler,
-    ContextTypes,
-    filters,
-)
-load_dotenv()
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-STATE_FILE = "contest_state.json"
-def now_utc() -> datetime:
-    return datetime.now(timezone.utc)
-def load_state() -> Dict:
-    if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
-def save_state(state: Dict):
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
-STATE = load_state()
-async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    chat = update.effective_chat
-    user = update.effective_user
-    if not chat or not user:
-        return False
-    member: ChatMember = await context.bot.get_chat_member(chat.id, user.id)
-    return member.status in ("administrator", "creator")
-def get_chat_state(chat_id: int) -> Dict:
-    key = str(chat_id)
-    if key not in STATE:
-        STATE[key] = {
-            "active": False,
-            "end_ts": 0,
-            "scores": {},
-            "pinned_message_id": None,
-            "links": {},
-        }
-    return STATE[key]
-def time_left_str(end_ts: int) -> str:
-    delta = max(0, end_ts - int(now_utc().timestamp()))
-    td = timedelta(seconds=delta)
-    days = td.days
-    hours = td.seconds // 3600
-    minutes = (td.seconds % 3600) // 60
-    parts = []
-    if days:
-        parts.append(f"{days} kun")
-    if hours:
-        parts.append(f"{hours} soat")
-    if minutes or not parts:
-        parts.append(f"{minutes} daqiqa")
-    return " ".join(parts)
-def format_user_mention(user_id: int) -> str:
-    return f'<a href="tg://user?id={user_id}">user_{user_id}</a>'
-async def render_leaderboard_text(chat_id: int) -> str:
-    cs = get_chat_state(chat_id)
-    scores = cs["scores"]
-    end_ts = cs["end_ts"]
-    active = cs["active"]
-    ranking = sorted(scores.items(), key=lambda kv: (-kv[1], int(kv[0])))
-    lines = []
-    if active:
-        lines.append("🏆 Tanlov boshlandi!")
-        lines.append(f"⏳ Qolgan vaqt: {time_left_str(end_ts)}")
-    else:
-        lines.append("🏁 Tanlov tugadi")
-    lines.append("")
-    if not ranking:
-        lines.append("Hali ball yo‘q. Birinchilardan bo‘ling!")
-    else:
-        lines.append("Yetakchilar ro‘yxati:")
-        for i, (uid_str, score) in enumerate(ranking[:20], start=1):
-            uid = int(uid_str)
-            lines.append(f"{i}. {format_user_mention(uid)} — {score}")
-    lines.append("")
-    return "\n".join(lines)
-async def update_pinned_leaderboard(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
-    cs = get_chat_state(chat_id)
-    text = await render_leaderboard_text(chat_id)
-    if cs.get("pinned_message_id"):
-        try:
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=cs["pinned_message_id"],
-                text=text,
-                parse_mode=ParseMode.HTML,
-                disable_web_page_preview=True,
-            )
-            return
-        except Exception:
-            cs["pinned_message_id"] = None
-    msg = await context.bot.send_message(
-        chat_id=chat_id,
-        text=text,
-        parse_mode=ParseMode.HTML,
-        disable_web_page_preview=True,
-    )
-    cs["pinned_message_id"] = msg.message_id
-    save_state(STATE)
-    try:
-        await context.bot.pin_chat_message(chat_id=chat_id, message_id=msg.message_id)
-    except Exception:
-        pass
-async def ensure_pinned_leaderboard(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
-    cs = get_chat_state(chat_id)
-    text = await render_leaderboard_text(chat_id)
-    if cs.get("pinned_message_id"):
-        try:
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=cs["pinned_message_id"],
-                text=text,
-                parse_mode=ParseMode.HTML,
-                disable_web_page_preview=True,
-            )
-            return
-        except Exception:
-            cs["pinned_message_id"] = None
-    msg = await context.bot.send_message(
-        chat_id=chat_id,
-        text=text,
-        parse_mode=ParseMode.HTML,
-        disable_web_page_preview=True,
-    )
-    cs["pinned_message_id"] = msg.message_id
-    save_state(STATE)
-    try:
-        await context.bot.pin_chat_message(chat_id=chat_id, message_id=msg.message_id)
-    except Exception:
-        pass
-async def delete_message_job(context: ContextTypes.DEFAULT_TYPE):
-    job = getattr(context, "job", None)
-    if not job:
-        return
-    try:
-        await context.bot.delete_message(
-            chat_id=job.chat_id, message_id=job.data["message_id"]
-        )
-    except Exception:
-        pass
-def schedule_delete(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, seconds: int = 60):
-    context.job_queue.run_once(
-        delete_message_job,
-        when=seconds,
-        chat_id=chat_id,
-        data={"message_id": message_id},
-    )
-async def auto_clean_reply(
-    update: Update,
-    context: ContextTypes.DEFAULT_TYPE,
-    text: str,
-    parse_mode: str = ParseMode.HTML,
-    seconds: int = 60,
-    skip_delete: bool = False,
-):
-    msg = await update.effective_message.reply_text(
-        text, parse_mode=parse_mode, disable_web_page_preview=True
-    )
-    if not skip_delete:
-        schedule_delete(context, msg.chat.id, msg.message_id, seconds)
-        try:
-            schedule_delete(context, update.effective_message.chat.id, update.effective_message.message_id, seconds)
-        except Exception:
-            pass
-    return msg
-async def end_contest(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
-    cs = get_chat_state(chat_id)
-    cs["active"] = False
-    for link_url, meta in list(cs["links"].items()):
-        if not meta.get("revoked"):
-            try:
-                await context.bot.revoke_chat_invite_link(chat_id=chat_id, invite_link=link_url)
-            except Exception:
-                pass
-            meta["revoked"] = True
-    save_state(STATE)
-    await update_pinned_leaderboard(chat_id, context)
-    # Cancel periodic update job
-    if hasattr(context, "job_queue"):
-        jobs = context.job_queue.get_jobs_by_name(f"periodic_{chat_id}")
-        for job in jobs:
-            job.schedule_removal()
-    scores = cs["scores"]
-    ranking = sorted(scores.items(), key=lambda kv: (-kv[1], int(kv[0])))
-    mentions = []
-    for i, (uid_str, score) in enumerate(ranking[:3], start=1):
-        uid = int(uid_str)
-        mentions.append(f"{i}-o‘rin: {format_user_mention(uid)} ({score} ball)")
-    text = "<b>Tanlov yakunlandi!</b>\n\n"
-    if mentions:
-        text += "\n".join(mentions)
-    else:
-        text += "Hech kim ishtirok etmadi."
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=text,
-        parse_mode=ParseMode.HTML,
-        disable_web_page_preview=True,
-    )
-async def periodic_leaderboard_update(context: ContextTypes.DEFAULT_TYPE):
-    job = getattr(context, "job", None)
-    if not job:
-        return
-    chat_id = job.chat_id
-    cs = get_chat_state(chat_id)
-    if cs.get("active"):
-        await ensure_pinned_leaderboard(chat_id, context)
-async def konkurs_end_job(context: ContextTypes.DEFAULT_TYPE):
-    job = getattr(context, "job", None)
-    if not job:
-        return
-    chat_id = job.chat_id
-    await end_contest(chat_id, context)
-async def konkurs_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat = update.effective_chat
-    cs = get_chat_state(chat.id)
-    days = 7
-    cs["active"] = True
-    cs["scores"] = {}
-    cs["links"] = {}
-    cs["end_ts"] = int((now_utc() + timedelta(days=days)).timestamp())
-    save_state(STATE)
-    await ensure_pinned_leaderboard(chat.id, context)  # This will send and pin the leaderboard table
-    await auto_clean_reply(
-        update,
-        context,
-        f"Tanlov {days} kun davom etadi!\n\n<i>Ushbu xabar 1 daqiqadan so‘ng o‘chiriladi.</i>",
-        skip_delete=False,
-    )
-    seconds_left = cs["end_ts"] - int(now_utc().timestamp())
-    if seconds_left > 0:
-        context.job_queue.run_once(
-            konkurs_end_job,
-            when=seconds_left,
-            chat_id=chat.id,
-            name=f"end_{chat.id}",
-        )
-        # Start periodic update every minute
-        context.job_queue.run_repeating(
-            periodic_leaderboard_update,
-            interval=60,
-            first=0,
-            chat_id=chat.id,
-            name=f"periodic_{chat.id}",
-        )
-async def konkurs_stop_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cs = get_chat_state(update.effective_chat.id)
-    if not cs.get("active"):
-        msg = await auto_clean_reply(
-            update,
-            context,
-            "<i>Hozircha to‘xtatiladigan tanlov yo‘q.</i>",
-            skip_delete=False,
-        )
-        try:
-            schedule_delete(context, update.effective_message.chat.id, update.effective_message.message_id, 60)
-        except Exception:
-            pass
-        return
-    if not await is_admin(update, context):
-        msg = await auto_clean_reply(update, context, "<i>Tanlovni faqat adminlar to‘xtatishi mumkin.</i>", skip_delete=False)
-        try:
-            schedule_delete(context, update.effective_message.chat.id, update.effective_message.message_id, 60)
-        except Exception:
-            pass
-        return
-    chat = update.effective_chat
-    await end_contest(chat.id, context)
-    # Auto-delete this notification message and the admin's command after 1 min
-    msg = await auto_clean_reply(
-        update,
-        context,
-        "Tanlov to‘xtatildi. Yakuniy yetakchilar ro‘yxati pin qilindi.\n\n<i>Ushbu xabar 1 daqiqadan so‘ng o‘chiriladi.</i>",
-        skip_delete=False,
-    )
-    try:
-        schedule_delete(context, update.effective_message.chat.id, update.effective_message.message_id, 60)
-    except Exception:
-        pass
-
-async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "Assalomu alaykum! Bu bot guruhda konkurslarni boshqaradi. /konkurs buyrug'ini ishlatib boshlang.",
-        parse_mode=ParseMode.HTML,
-    )
-
-
-async def konkurs_status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat = update.effective_chat
-    cs = get_chat_state(chat.id)
-    if not cs.get("active"):
-        msg = await auto_clean_reply(
-            update,
-            context,
-            "<i>Hozircha tanlov yo‘q. Yangi tanlov boshlanishini kuting.</i>",
-            skip_delete=False,  # Enable auto-delete
-        )
-        # Also schedule deletion of the admin's command message (if not already handled)
-        try:
-            schedule_delete(context, update.effective_message.chat.id, update.effective_message.message_id, 60)
-        except Exception:
-            pass
-        return
-    text = await render_leaderboard_text(chat.id)
-    await auto_clean_reply(
-        update,
-        context,
-        text + "\n\n<i>Ushbu xabar 1 daqiqadan so‘ng o‘chiriladi.</i>",
-        skip_delete=True,  # Do not auto-delete leaderboard/status replies
-    )
-def credit_invite(chat_id: int, inviter_id: int, count: int = 1):
-    cs = get_chat_state(chat_id)
-    if not cs["active"]:
-        return
-    scores = cs["scores"]
-    scores[str(inviter_id)] = scores.get(str(inviter_id), 0) + count
-    save_state(STATE)
-async def on_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat = update.effective_chat
-    msg = update.effective_message
-    cs = get_chat_state(chat.id)
-    if not msg or not msg.new_chat_members:
-        return
-    credited = False
-    for member in msg.new_chat_members:
-        if msg.from_user and msg.from_user.id != member.id:
-            inviter_id = msg.from_user.id
-            credit_invite(chat.id, inviter_id, 1)
-            credited = True
-        else:
-            link_url = None
-            try:
-                if getattr(msg, "invite_link", None):
-                    link_url = msg.invite_link.invite_link
-            except Exception:
-                link_url = None
-            if link_url and link_url in cs["links"]:
-                inviter_id = cs["links"][link_url]["creator_id"]
-                credit_invite(chat.id, inviter_id, 1)
-                credited = True
-    if cs["active"] and credited:
-        await ensure_pinned_leaderboard(chat.id, context)  # Update the pinned leaderboard in real time
-    try:
-        await msg.delete()
-    except Exception:
-        pass
-
-
-async def cleanup_system_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    msg = update.effective_message
-    if not msg:
-        return
-
-    should_delete = False
-    if msg.left_chat_member:
-        should_delete = True
-    if msg.pinned_message:
-        should_delete = True
-    if msg.new_chat_title:
-        should_delete = True
-    if msg.new_chat_photo or msg.delete_chat_photo:
-        should_delete = True
-
-    if should_delete:
-        try:
-            await msg.delete()
-        except Exception:
-            pass
-
-async def dev_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = (
-        "<b>Just remove</b>\n"
-        "Bu bot guruhda konkurs o`tkazishi,hamda shu bilan birgalikda barcha tizim habarlarini\n Masalan Guruhga qo`shildi, Guruhni tark etdi, Habar qadaldi va hokazolardan ham tozalab turadi.\n"
-        "Adminlar konkursni boshlashi mumkin.\n"
-        "\n"
-        "Bot dasturchisi: <b>@xoqon2003</b>"
-    )
-    await auto_clean_reply(update, context, text)
-
-    
-def main():
-    if not BOT_TOKEN:
-        raise RuntimeError("BOT_TOKEN not set in environment")
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-    app.add_handler(CommandHandler("start", start_cmd))
-    app.add_handler(CommandHandler("konkurs", konkurs_cmd))
-    app.add_handler(CommandHandler("konkurs_stop", konkurs_stop_cmd))
-    app.add_handler(CommandHandler("konkurs_status", konkurs_status_cmd))
-    app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, on_new_members))
-    sys_cleanup_filter = (
-        filters.StatusUpdate.LEFT_CHAT_MEMBER
-        | filters.StatusUpdate.PINNED_MESSAGE
-        | filters.StatusUpdate.NEW_CHAT_TITLE
-        | filters.StatusUpdate.NEW_CHAT_PHOTO
-        | filters.StatusUpdate.DELETE_CHAT_PHOTO
-    )
-    app.add_handler(MessageHandler(sys_cleanup_filter, cleanup_system_messages))
-    # Allow /dev for everyone (no admin check)
-    app.add_handler(CommandHandler("dev", dev_cmd, block=False))
-    app.run_polling()
-if __name__ == "__main__":
+import os
+import asyncio
+import time
+import heapq
+import bisect
+import random
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+from telegram import Update, ChatMember, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden
+from telegram.ext import (
+    Application,
+    ApplicationBuilder,
+    CallbackQueryHandler,
+    ChatMemberHandler,
+    CommandHandler,
+    MessageHandler,
+    TypeHandler,
+    ContextTypes,
+    filters,
+)
+from storage import (
+    DAY,
+    HOUR,
+    JsonStorage,
+    SqliteStorage,
+    count_joins,
+    dump_chat,
+    migrate_json_to_sqlite,
+    needs_finish,
+    new_chat_state,
+    write_json_atomic,
+)
+from history import busiest, joins_by_bucket
+from profiles import ProfileCache
+from ranking import RankIndex
+from scores import CreditedMembers, ScoreTable
+from dispatcher import (
+    ApiDispatcher,
+    PRIORITY_ANNOUNCE,
+    PRIORITY_CLEANUP,
+    PRIORITY_LEADERBOARD,
+    PRIORITY_REPLY,
+)
+from serving import run_application
+from sharding import HashRing
+import metrics
+from metrics import REGISTRY, SCHEDULER_EVENTS, time_handler
+from processing import ChatOrderedUpdateProcessor
+load_dotenv()
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL")
+STATE_FILE = os.getenv("STATE_FILE", "contest_state.json")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+DB_FILE = os.getenv("DB_FILE", "contest_state.db")
+EVENT_LOG_FILE = os.getenv("EVENT_LOG_FILE", "contest_events.log")
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "5"))
+LEADERBOARD_EDIT_WINDOW = float(os.getenv("LEADERBOARD_EDIT_WINDOW", "3"))
+LEADERBOARD_REFRESH_INTERVAL = float(os.getenv("LEADERBOARD_REFRESH_INTERVAL", "60"))
+SCHEDULER_TICK = float(os.getenv("SCHEDULER_TICK", "1"))
+API_GLOBAL_RATE = float(os.getenv("API_GLOBAL_RATE", "30"))
+API_CHAT_RATE = float(os.getenv("API_CHAT_RATE", "1"))
+API_CHAT_BURST = float(os.getenv("API_CHAT_BURST", "5"))
+API_WORKERS = int(os.getenv("API_WORKERS", "8"))
+ADMIN_CACHE_TTL = float(os.getenv("ADMIN_CACHE_TTL", "600"))
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "0"))
+UPDATE_SHED_THRESHOLD = int(os.getenv("UPDATE_SHED_THRESHOLD", "1000"))
+JOIN_BURST_WINDOW = float(os.getenv("JOIN_BURST_WINDOW", "1"))
+REVOKE_CONCURRENCY = int(os.getenv("REVOKE_CONCURRENCY", "4"))
+REVOKE_RETRIES = int(os.getenv("REVOKE_RETRIES", "5"))
+REVOKE_RETRY_DELAY = float(os.getenv("REVOKE_RETRY_DELAY", "2"))
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "1000"))
+QUICK_LEAVE_SECONDS = float(os.getenv("QUICK_LEAVE_SECONDS", "0"))
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "100000"))
+LEADERBOARD_PAGE_SIZE = int(os.getenv("LEADERBOARD_PAGE_SIZE", "20"))
+# set by sharding.py for each worker process
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+def now_utc() -> datetime:
+    return datetime.now(timezone.utc)
+def open_storage():
+    if STORAGE_BACKEND == "sqlite":
+        storage = SqliteStorage(DB_FILE)
+        migrate_json_to_sqlite(STATE_FILE, storage)
+        return storage
+    return JsonStorage(STATE_FILE, EVENT_LOG_FILE)
+STORAGE = open_storage()
+def load_state() -> Dict:
+    return STORAGE.load_chats()
+def save_state(state: Dict):
+    write_json_atomic(STATE_FILE, [(key, dump_chat(cs)) for key, cs in state.items()])
+# Resident chat states in least-recently-used order. Chats with a running
+# contest or pending work are never evicted; the rest are written back to
+# the storage layer once more than CHAT_CACHE_SIZE chats are resident.
+STATE: "OrderedDict[str, Dict]" = OrderedDict(load_state())
+PROFILES = ProfileCache(PROFILE_CACHE_SIZE)
+PROFILES.load(STORAGE.load_profiles(PROFILE_CACHE_SIZE))
+API = ApiDispatcher(
+    global_rate=API_GLOBAL_RATE,
+    chat_rate=API_CHAT_RATE,
+    chat_burst=API_CHAT_BURST,
+    workers=API_WORKERS,
+)
+def mark_dirty(chat_id):
+    STORAGE.mark_dirty(chat_id)
+async def flush_state():
+    changes = PROFILES.take_changes()
+    if changes:
+        STORAGE.record_profiles(changes, PROFILES.items())
+    await STORAGE.flush(STATE)
+async def flush_state_job(context: ContextTypes.DEFAULT_TYPE):
+    await flush_state()
+async def on_shutdown(app: Application):
+    flush_join_bursts()
+    await stop_link_revocations()
+    await metrics.stop_server()
+    await API.stop()
+    await flush_state()
+    STORAGE.close()
+# Administrator ids per chat, seeded with one get_chat_administrators call,
+# kept current from chat_member updates and refetched after ADMIN_CACHE_TTL.
+ADMINS: Dict[str, Tuple[float, set]] = {}
+ADMIN_FETCHES: Dict[str, asyncio.Future] = {}
+async def get_chat_admins(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> set:
+    key = str(chat_id)
+    cached = ADMINS.get(key)
+    if cached and time.monotonic() - cached[0] < ADMIN_CACHE_TTL:
+        return cached[1]
+    pending = ADMIN_FETCHES.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    future = asyncio.get_running_loop().create_future()
+    ADMIN_FETCHES[key] = future
+    try:
+        members = await API.call(PRIORITY_REPLY, chat_id, context.bot.get_chat_administrators, chat_id)
+        ADMINS[key] = (time.monotonic(), {member.user.id for member in members})
+        if len(ADMINS) > CHAT_CACHE_SIZE:
+            # admin checks can come from chats that are never loaded
+            for other in [k for k in ADMINS if k != key and k not in STATE and k not in ADMIN_FETCHES]:
+                del ADMINS[other]
+    except Exception as e:
+        if not cached:
+            future.set_exception(e)
+            future.exception()  # waiters re-raise it; don't warn about it here
+            raise
+        # keep answering from the stale list until a refresh succeeds
+    finally:
+        del ADMIN_FETCHES[key]
+    admins = ADMINS[key][1]
+    future.set_result(admins)
+    return admins
+async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    chat = update.effective_chat
+    user = update.effective_user
+    if not chat or not user:
+        return False
+    return user.id in await get_chat_admins(chat.id, context)
+async def on_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    change = update.chat_member
+    user_id = change.new_chat_member.user.id
+    cached = ADMINS.get(str(change.chat.id))
+    if cached:
+        if change.new_chat_member.status in (ChatMember.ADMINISTRATOR, ChatMember.OWNER):
+            cached[1].add(user_id)
+        else:
+            cached[1].discard(user_id)
+    # joins through a personal link are only reported here, with the link used
+    joined = (
+        change.old_chat_member.status in (ChatMember.LEFT, ChatMember.BANNED)
+        and change.new_chat_member.status == ChatMember.MEMBER
+    )
+    if joined and change.invite_link:
+        cs = get_chat_state(change.chat.id)
+        meta = cs["links"].get(change.invite_link.invite_link)
+        if meta and meta.get("creator_id") not in (None, user_id):
+            if claim_member(change.chat.id, cs, user_id, meta["creator_id"]):
+                queue_join_credits(change.chat.id, {meta["creator_id"]: 1}, [], context, [user_id])
+    left = (
+        change.old_chat_member.status in (ChatMember.MEMBER, ChatMember.RESTRICTED)
+        and change.new_chat_member.status in (ChatMember.LEFT, ChatMember.BANNED)
+    )
+    if left:
+        debit_quick_leave(change.chat.id, user_id, context)
+# A sharded worker shares the SQLite database with the others, so on startup
+# it picks up only the chats the front routes to it.
+SHARD_RING = HashRing(SHARD_COUNT) if SHARD_COUNT > 1 else None
+def owned_chat_ids(keys: List[str]) -> List[str]:
+    if SHARD_RING is None:
+        return keys
+    return [key for key in keys if SHARD_RING.node_for(key) == SHARD_INDEX]
+def get_chat_state(chat_id: int) -> Dict:
+    key = str(chat_id)
+    cs = STATE.get(key)
+    if cs is not None:
+        STATE.move_to_end(key)
+        return cs
+    cs = STORAGE.load_chat(key)
+    if cs is None:
+        cs = new_chat_state()
+    STATE[key] = cs
+    if len(STATE) > CHAT_CACHE_SIZE:
+        evict_chats(keep=key)
+    return cs
+def is_evictable(key: str, cs: Dict) -> bool:
+    # anything still holding on to this dict across an await keeps it resident
+    return not (
+        cs.get("active")
+        or key in ENDING
+        or key in REVOCATIONS
+        or key in JOIN_BURSTS
+        or any(fetch[0] == key for fetch in USER_LINK_FETCHES)
+    )
+def evict_chats(keep: Optional[str] = None):
+    # keep: the chat being loaded, which its caller is about to use
+    for key in list(STATE):
+        if len(STATE) <= CHAT_CACHE_SIZE:
+            break
+        cs = STATE[key]
+        if key == keep or not is_evictable(key, cs):
+            continue
+        del STATE[key]
+        forget_chat(key)
+        STORAGE.evict(key, cs)
+def forget_chat(key: str):
+    # per-chat caches follow the chat out of memory; all are rebuilt on demand
+    RANKS.pop(key, None)
+    PAGE_CACHE.pop(key, None)
+    SCORE_VERSIONS.pop(key, None)
+    LEADERBOARD_HASHES.pop(key, None)
+    LEADERBOARD_LAST_EDIT.pop(key, None)
+    RECENT_JOINS.pop(key, None)
+    if key not in ADMIN_FETCHES:
+        ADMINS.pop(key, None)
+RANKS: Dict[str, RankIndex] = {}
+def get_rank_index(chat_id: int) -> RankIndex:
+    # Rebuilt whenever the chat's score table is replaced (new contest, reload)
+    cs = get_chat_state(chat_id)
+    index = RANKS.get(str(chat_id))
+    if index is None or index.source is not cs["scores"]:
+        index = RANKS[str(chat_id)] = RankIndex(cs["scores"])
+    return index
+def time_left_str(end_ts: int) -> str:
+    delta = max(0, end_ts - int(now_utc().timestamp()))
+    td = timedelta(seconds=delta)
+    days = td.days
+    hours = td.seconds // 3600
+    minutes = (td.seconds % 3600) // 60
+    parts = []
+    if days:
+        parts.append(f"{days} kun")
+    if hours:
+        parts.append(f"{hours} soat")
+    if minutes or not parts:
+        parts.append(f"{minutes} daqiqa")
+    return " ".join(parts)
+def format_user_mention(user_id: int) -> str:
+    name = PROFILES.get(user_id) or f"user_{user_id}"
+    return f'<a href="tg://user?id={user_id}">{name}</a>'
+async def remember_profiles(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # runs ahead of every other handler; names cost no API calls this way
+    PROFILES.remember(update.effective_user)
+    msg = update.effective_message
+    if msg and msg.new_chat_members:
+        for member in msg.new_chat_members:
+            PROFILES.remember(member)
+    if update.chat_member:
+        PROFILES.remember(update.chat_member.new_chat_member.user)
+async def render_leaderboard_text(chat_id: int) -> str:
+    cs = get_chat_state(chat_id)
+    end_ts = cs["end_ts"]
+    active = cs["active"]
+    ranking = get_rank_index(chat_id).top(20)
+    lines = []
+    if active:
+        lines.append("🏆 Tanlov boshlandi!")
+        lines.append(f"⏳ Qolgan vaqt: {time_left_str(end_ts)}")
+    else:
+        lines.append("🏁 Tanlov tugadi")
+    lines.append("")
+    if not ranking:
+        lines.append("Hali ball yo‘q. Birinchilardan bo‘ling! Shaxsiy havola: /mylink")
+    else:
+        lines.append("Yetakchilar ro‘yxati:")
+        for i, (uid, score) in enumerate(ranking, start=1):
+            lines.append(f"{i}. {format_user_mention(uid)} — {score}")
+    lines.append("")
+    return "\n".join(lines)
+# Leaderboard pages behind the inline keyboard of /konkurs_status and
+# /myrank. Rendered page bodies are cached per chat and dropped as a whole
+# when credit_invites() bumps the chat's score version or the score table
+# is replaced, so flipping pages of a quiet board renders nothing.
+SCORE_VERSIONS: Dict[str, int] = {}
+PAGE_CACHE: Dict[str, Tuple[RankIndex, int, Dict[int, str]]] = {}
+PAGE_CACHE_PAGES = 32
+def page_count(index: RankIndex) -> int:
+    return max(1, -(-len(index) // LEADERBOARD_PAGE_SIZE))
+def leaderboard_page_body(chat_id: int, page: int) -> str:
+    key = str(chat_id)
+    index = get_rank_index(chat_id)
+    version = SCORE_VERSIONS.get(key, 0)
+    cached = PAGE_CACHE.get(key)
+    if cached is None or cached[0] is not index or cached[1] != version:
+        cached = PAGE_CACHE[key] = (index, version, {})
+    pages = cached[2]
+    body = pages.get(page)
+    if body is None:
+        start = (page - 1) * LEADERBOARD_PAGE_SIZE
+        body = "\n".join(
+            f"{i}. {format_user_mention(uid)} — {score}"
+            for i, (uid, score) in enumerate(index.slice(start, start + LEADERBOARD_PAGE_SIZE), start=start + 1)
+        )
+        if len(pages) >= PAGE_CACHE_PAGES:
+            del pages[next(iter(pages))]
+        pages[page] = body
+    return body
+def render_leaderboard_page(chat_id: int, page: int) -> Tuple[str, InlineKeyboardMarkup]:
+    cs = get_chat_state(chat_id)
+    last = page_count(get_rank_index(chat_id))
+    page = min(max(1, page), last)
+    if cs["active"]:
+        lines = ["🏆 Yetakchilar ro‘yxati", f"⏳ Qolgan vaqt: {time_left_str(cs['end_ts'])}", ""]
+    else:
+        lines = ["🏁 Tanlov tugadi", ""]
+    body = leaderboard_page_body(chat_id, page)
+    lines.append(body or "Hali ball yo‘q. Birinchilardan bo‘ling! Shaxsiy havola: /mylink")
+    if last == 1:
+        return "\n".join(lines), None
+    lines += ["", f"Sahifa {page}/{last}"]
+    buttons = []
+    if page > 1:
+        buttons.append(InlineKeyboardButton("⬅️", callback_data=f"lb:{page - 1}"))
+    if page < last:
+        buttons.append(InlineKeyboardButton("➡️", callback_data=f"lb:{page + 1}"))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons])
+async def leaderboard_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await API.call(PRIORITY_REPLY, None, query.answer)
+    page = query.data.split(":", 1)[1]
+    if not query.message or not page.isdigit():
+        return
+    text, keyboard = render_leaderboard_page(query.message.chat.id, int(page))
+    try:
+        await API.call(
+            PRIORITY_REPLY,
+            query.message.chat.id,
+            query.edit_message_text,
+            text,
+            parse_mode=ParseMode.HTML,
+            disable_web_page_preview=True,
+            reply_markup=keyboard,
+        )
+    except BadRequest:
+        pass  # the page did not change since the message was rendered
+async def update_pinned_leaderboard(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
+    await ensure_pinned_leaderboard(chat_id, context)
+# Hash of the text last shown in each chat's pinned message, keyed by chat and
+# paired with that message id, so re-rendering an unchanged board is a no-op.
+LEADERBOARD_HASHES: Dict[str, tuple] = {}
+LEADERBOARD_LAST_EDIT: Dict[str, float] = {}
+PENDING_REFRESH = set()
+async def ensure_pinned_leaderboard(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
+    cs = get_chat_state(chat_id)
+    key = str(chat_id)
+    text = await render_leaderboard_text(chat_id)
+    text_hash = hash(text)
+    pinned_id = cs.get("pinned_message_id")
+    if pinned_id:
+        if LEADERBOARD_HASHES.get(key) == (pinned_id, text_hash):
+            return
+        try:
+            await API.call(
+                PRIORITY_LEADERBOARD,
+                chat_id,
+                context.bot.edit_message_text,
+                chat_id=chat_id,
+                message_id=pinned_id,
+                text=text,
+                parse_mode=ParseMode.HTML,
+                disable_web_page_preview=True,
+            )
+            LEADERBOARD_HASHES[key] = (pinned_id, text_hash)
+            LEADERBOARD_LAST_EDIT[key] = time.monotonic()
+            return
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                LEADERBOARD_HASHES[key] = (pinned_id, text_hash)
+                return
+            cs["pinned_message_id"] = None
+            mark_dirty(chat_id)
+        except Exception:
+            cs["pinned_message_id"] = None
+            mark_dirty(chat_id)
+    msg = await API.call(
+        PRIORITY_LEADERBOARD,
+        chat_id,
+        context.bot.send_message,
+        chat_id=chat_id,
+        text=text,
+        parse_mode=ParseMode.HTML,
+        disable_web_page_preview=True,
+    )
+    cs["pinned_message_id"] = msg.message_id
+    LEADERBOARD_HASHES[key] = (msg.message_id, text_hash)
+    LEADERBOARD_LAST_EDIT[key] = time.monotonic()
+    mark_dirty(chat_id)
+    try:
+        await API.call(PRIORITY_LEADERBOARD, chat_id, context.bot.pin_chat_message, chat_id=chat_id, message_id=msg.message_id)
+    except Exception:
+        pass
+async def leaderboard_refresh_job(context: ContextTypes.DEFAULT_TYPE):
+    job = getattr(context, "job", None)
+    if not job:
+        return
+    PENDING_REFRESH.discard(str(job.chat_id))
+    if get_chat_state(job.chat_id).get("active"):
+        await ensure_pinned_leaderboard(job.chat_id, context)
+def request_leaderboard_refresh(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
+    # Coalesce refresh triggers: at most one edit per LEADERBOARD_EDIT_WINDOW,
+    # rendered from whatever the state is when the edit actually runs.
+    key = str(chat_id)
+    if key in PENDING_REFRESH:
+        return
+    PENDING_REFRESH.add(key)
+    last_edit = LEADERBOARD_LAST_EDIT.get(key)
+    delay = 0.0
+    if last_edit is not None:
+        delay = max(0.0, last_edit + LEADERBOARD_EDIT_WINDOW - time.monotonic())
+    context.job_queue.run_once(
+        leaderboard_refresh_job,
+        when=delay,
+        chat_id=chat_id,
+        name=f"refresh_{chat_id}",
+    )
+# Pending deletions live in each chat's state as a time-ordered
+# "delete_queue" of [due_ts, message_id] pairs, so they survive restarts.
+# DELETE_QUEUE holds (due_ts, chat_key) for each chat's earliest entry and the
+# scheduler tick flushes due ids through bulk delete_messages calls.
+DELETE_QUEUE: List[Tuple[int, str]] = []
+DELETE_NEXT: Dict[str, int] = {}
+DELETE_BATCH_SIZE = 100
+def _schedule_delete_flush(key: str, due: int):
+    if key not in DELETE_NEXT or due < DELETE_NEXT[key]:
+        DELETE_NEXT[key] = due
+        heapq.heappush(DELETE_QUEUE, (due, key))
+def schedule_deletes(chat_id: int, message_ids: List[int], seconds: int = 60):
+    if not message_ids:
+        return
+    cs = get_chat_state(chat_id)
+    due = int(now_utc().timestamp()) + seconds
+    queue = cs.setdefault("delete_queue", [])
+    for message_id in message_ids:
+        if not queue or queue[-1][0] <= due:
+            queue.append([due, message_id])
+        else:
+            bisect.insort(queue, [due, message_id])
+    mark_dirty(chat_id)
+    _schedule_delete_flush(str(chat_id), due)
+def schedule_delete(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, seconds: int = 60):
+    schedule_deletes(chat_id, [message_id], seconds)
+def restore_delete_queues():
+    for key in owned_chat_ids(STORAGE.pending_delete_chat_ids(STATE)):
+        queue = get_chat_state(int(key)).get("delete_queue")
+        if queue:
+            _schedule_delete_flush(key, queue[0][0])
+def flush_due_deletes(context: ContextTypes.DEFAULT_TYPE, now: int):
+    while DELETE_QUEUE and DELETE_QUEUE[0][0] <= now:
+        due, key = heapq.heappop(DELETE_QUEUE)
+        if DELETE_NEXT.get(key) != due:
+            continue
+        del DELETE_NEXT[key]
+        cs = get_chat_state(int(key))
+        queue = cs.get("delete_queue") or []
+        split = bisect.bisect_right(queue, [now, float("inf")])
+        message_ids = [message_id for _, message_id in queue[:split]]
+        del queue[:split]
+        if queue:
+            _schedule_delete_flush(key, queue[0][0])
+        else:
+            cs.pop("delete_queue", None)
+        mark_dirty(key)
+        for i in range(0, len(message_ids), DELETE_BATCH_SIZE):
+            SCHEDULER_EVENTS.inc("delete_batch")
+            API.submit(
+                PRIORITY_CLEANUP,
+                int(key),
+                context.bot.delete_messages,
+                chat_id=int(key),
+                message_ids=message_ids[i:i + DELETE_BATCH_SIZE],
+            )
+async def auto_clean_reply(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    text: str,
+    parse_mode: str = ParseMode.HTML,
+    seconds: int = 60,
+    skip_delete: bool = False,
+    reply_markup=None,
+):
+    msg = await API.call(
+        PRIORITY_REPLY,
+        update.effective_chat.id,
+        update.effective_message.reply_text,
+        text,
+        parse_mode=parse_mode,
+        disable_web_page_preview=True,
+        reply_markup=reply_markup,
+    )
+    if not skip_delete:
+        schedule_delete(context, msg.chat.id, msg.message_id, seconds)
+        try:
+            schedule_delete(context, update.effective_message.chat.id, update.effective_message.message_id, seconds)
+        except Exception:
+            pass
+    return msg
+ENDING = set()
+async def end_contest(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
+    cs = get_chat_state(chat_id)
+    # joins still collecting in a burst arrived while the contest ran
+    burst = JOIN_BURSTS.pop(str(chat_id), None)
+    if burst:
+        apply_join_burst(chat_id, burst["counts"], burst["message_ids"], members=burst["members"])
+    cs["active"] = False
+    # stopped early: the archive should show when it actually ended
+    cs["end_ts"] = min(cs["end_ts"], int(now_utc().timestamp()))
+    STORAGE.record_end(chat_id, cs["end_ts"])
+    mark_dirty(chat_id)
+    unschedule_contest(chat_id)
+    ENDING.add(str(chat_id))
+    RECENT_JOINS.pop(str(chat_id), None)
+    try:
+        await update_pinned_leaderboard(chat_id, context)
+        mentions = []
+        for i, (uid, score) in enumerate(get_rank_index(chat_id).top(3), start=1):
+            mentions.append(f"{i}-o‘rin: {format_user_mention(uid)} ({score} ball)")
+        text = "<b>Tanlov yakunlandi!</b>\n\n"
+        if mentions:
+            text += "\n".join(mentions)
+        else:
+            text += "Hech kim ishtirok etmadi."
+        await API.call(
+            PRIORITY_ANNOUNCE,
+            chat_id,
+            context.bot.send_message,
+            chat_id=chat_id,
+            text=text,
+            parse_mode=ParseMode.HTML,
+            disable_web_page_preview=True,
+        )
+    finally:
+        ENDING.discard(str(chat_id))
+        finish_contest(chat_id, context.bot)
+# Personal invite links are revoked after the results are out, by a
+# background pipeline per chat with REVOKE_CONCURRENCY calls in flight. Each
+# revoked link is recorded as it completes, so a restart resumes with the
+# links that are still pending. A transient failure is retried up to
+# REVOKE_RETRIES times, the delay doubling from REVOKE_RETRY_DELAY seconds.
+# Once every link is revoked the contest's scores and links move to the
+# archive and the chat can leave memory.
+REVOCATIONS: Dict[str, asyncio.Task] = {}
+def finish_contest(chat_id: int, bot):
+    key = str(chat_id)
+    task = REVOCATIONS.get(key)
+    if task is not None and not task.done():
+        return
+    REVOCATIONS[key] = asyncio.get_running_loop().create_task(revoke_contest_links(chat_id, bot))
+async def revoke_contest_links(chat_id: int, bot):
+    cs = get_chat_state(chat_id)
+    links = cs["links"]
+    pending = iter([link_url for link_url, meta in links.items() if not meta.get("revoked")])
+    async def revoke(link_url: str) -> bool:
+        for attempt in range(max(0, REVOKE_RETRIES) + 1):
+            if attempt:
+                await asyncio.sleep(REVOKE_RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                # no chat_id: revoking sends nothing to the chat, so only the
+                # global bucket applies rather than the per-chat message rate
+                await API.call(PRIORITY_CLEANUP, None, bot.revoke_chat_invite_link, chat_id=chat_id, invite_link=link_url)
+                return True
+            except (BadRequest, Forbidden):
+                return True  # already revoked, or no longer ours to revoke
+            except Exception:
+                pass  # transient; retried after a backoff
+        return False  # left pending for the next restart
+    async def revoke_worker():
+        for link_url in pending:
+            if not await revoke(link_url):
+                continue
+            links[link_url]["revoked"] = True
+            if cs["links"] is links:
+                STORAGE.record_link(chat_id, link_url, links[link_url])
+    try:
+        await asyncio.gather(*(revoke_worker() for _ in range(max(1, REVOKE_CONCURRENCY))))
+        if cs["links"] is links and not any(not meta.get("revoked") for meta in links.values()):
+            archive_contest(chat_id)
+    finally:
+        if REVOCATIONS.get(str(chat_id)) is asyncio.current_task():
+            del REVOCATIONS[str(chat_id)]
+def archive_contest(chat_id: int):
+    cs = get_chat_state(chat_id)
+    if not needs_finish(cs):
+        return
+    STORAGE.archive_contest(chat_id, cs)
+    cs["scores"] = ScoreTable()
+    cs["links"] = {}
+    cs["user_links"] = {}
+    RANKS.pop(str(chat_id), None)
+    PAGE_CACHE.pop(str(chat_id), None)
+def restore_contest_finishes(bot):
+    for key in owned_chat_ids(STORAGE.pending_finish_chat_ids(STATE)):
+        finish_contest(int(key), bot)
+async def stop_link_revocations():
+    tasks = list(REVOCATIONS.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+# One repeating scheduler_tick job drives every active contest: a heap of
+# end timestamps fires contest ends (including ones that came due while the
+# bot was down), and a heap of refresh deadlines spreads the periodic
+# leaderboard refreshes across LEADERBOARD_REFRESH_INTERVAL with jitter.
+END_QUEUE: List[Tuple[int, str]] = []
+REFRESH_QUEUE: List[Tuple[float, str]] = []
+REFRESH_DUE: Dict[str, float] = {}
+def schedule_contest(chat_id: int, end_ts: int):
+    key = str(chat_id)
+    heapq.heappush(END_QUEUE, (end_ts, key))
+    if key not in REFRESH_DUE:
+        due = time.monotonic() + random.uniform(0, LEADERBOARD_REFRESH_INTERVAL)
+        REFRESH_DUE[key] = due
+        heapq.heappush(REFRESH_QUEUE, (due, key))
+def unschedule_contest(chat_id: int):
+    # stale heap entries are skipped when they are popped
+    REFRESH_DUE.pop(str(chat_id), None)
+def restore_contests():
+    for key in owned_chat_ids(STORAGE.active_chat_ids(STATE)):
+        schedule_contest(int(key), get_chat_state(int(key))["end_ts"])
+async def scheduler_tick(context: ContextTypes.DEFAULT_TYPE):
+    now = int(now_utc().timestamp())
+    SCHEDULER_EVENTS.inc("tick")
+    flush_due_deletes(context, now)
+    while END_QUEUE and END_QUEUE[0][0] <= now:
+        end_ts, key = heapq.heappop(END_QUEUE)
+        cs = get_chat_state(int(key))
+        if cs.get("active") and cs["end_ts"] == end_ts:
+            SCHEDULER_EVENTS.inc("contest_end")
+            context.application.create_task(end_contest(int(key), context))
+    mono = time.monotonic()
+    while REFRESH_QUEUE and REFRESH_QUEUE[0][0] <= mono:
+        due, key = heapq.heappop(REFRESH_QUEUE)
+        if REFRESH_DUE.get(key) != due:
+            continue
+        if not get_chat_state(int(key)).get("active"):
+            del REFRESH_DUE[key]
+            continue
+        SCHEDULER_EVENTS.inc("leaderboard_refresh")
+        request_leaderboard_refresh(int(key), context)
+        due += LEADERBOARD_REFRESH_INTERVAL
+        REFRESH_DUE[key] = due
+        heapq.heappush(REFRESH_QUEUE, (due, key))
+async def on_startup(app: Application):
+    API.start()
+    restore_contests()
+    restore_delete_queues()
+    restore_contest_finishes(app.bot)
+    await metrics.start_server()
+@REGISTRY.collector
+def collect_metrics():
+    active = [cs for cs in STATE.values() if cs.get("active")]
+    metrics.ACTIVE_CHATS.set(value=len(active))
+    metrics.RESIDENT_CHATS.set(value=len(STATE))
+    metrics.PARTICIPANTS.set(value=sum(len(cs["scores"]) for cs in active))
+    metrics.SCHEDULED.set("contest_end", value=len(END_QUEUE))
+    metrics.SCHEDULED.set("leaderboard_refresh", value=len(REFRESH_DUE))
+    metrics.SCHEDULED.set("pending_edit", value=len(PENDING_REFRESH))
+    metrics.SCHEDULED.set("delete_flush", value=len(DELETE_NEXT))
+    metrics.SCHEDULED.set("join_burst", value=len(JOIN_BURSTS))
+    metrics.SCHEDULED.set("link_revocation", value=len(REVOCATIONS))
+    stats = API.stats()
+    for priority, depth in stats["queue_depth"].items():
+        metrics.API_QUEUE_DEPTH.set(priority, value=depth)
+    metrics.API_PARKED.set(value=stats["parked"])
+    metrics.API_CHAT_CALLS.clear()
+    for chat_id, calls in metrics.top_items(API.chat_calls, metrics.METRICS_TOP_CHATS):
+        metrics.API_CHAT_CALLS.set(chat_id, value=calls)
+async def konkurs_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    cs = get_chat_state(chat.id)
+    days = 7
+    if cs.get("scores") or cs.get("links"):
+        # keep the previous contest in the history, even one cut short here
+        if cs.get("active"):
+            cs["end_ts"] = int(now_utc().timestamp())
+        STORAGE.archive_contest(chat.id, cs)
+    cs["active"] = True
+    cs["scores"] = ScoreTable()
+    cs["links"] = {}
+    cs["user_links"] = {}
+    cs["joins_hourly"] = {}
+    cs["credited"] = CreditedMembers()
+    RECENT_JOINS.pop(str(chat.id), None)
+    cs["start_ts"] = int(now_utc().timestamp())
+    cs["end_ts"] = int((now_utc() + timedelta(days=days)).timestamp())
+    STORAGE.record_start(chat.id, cs["end_ts"])
+    await ensure_pinned_leaderboard(chat.id, context)  # This will send and pin the leaderboard table
+    await auto_clean_reply(
+        update,
+        context,
+        f"Tanlov {days} kun davom etadi!\n\n<i>Ushbu xabar 1 daqiqadan so‘ng o‘chiriladi.</i>",
+        skip_delete=False,
+    )
+    schedule_contest(chat.id, cs["end_ts"])
+async def konkurs_stop_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    cs = get_chat_state(update.effective_chat.id)
+    if not cs.get("active"):
+        msg = await auto_clean_reply(
+            update,
+            context,
+            "<i>Hozircha to‘xtatiladigan tanlov yo‘q.</i>",
+            skip_delete=False,
+        )
+        try:
+            schedule_delete(context, update.effective_message.chat.id, update.effective_message.message_id, 60)
+        except Exception:
+            pass
+        return
+    if not await is_admin(update, context):
+        msg = await auto_clean_reply(update, context, "<i>Tanlovni faqat adminlar to‘xtatishi mumkin.</i>", skip_delete=False)
+        try:
+            schedule_delete(context, update.effective_message.chat.id, update.effective_message.message_id, 60)
+        except Exception:
+            pass
+        return
+    chat = update.effective_chat
+    await end_contest(chat.id, context)
+    # Auto-delete this notification message and the admin's command after 1 min
+    msg = await auto_clean_reply(
+        update,
+        context,
+        "Tanlov to‘xtatildi. Yakuniy yetakchilar ro‘yxati pin qilindi.\n\n<i>Ushbu xabar 1 daqiqadan so‘ng o‘chiriladi.</i>",
+        skip_delete=False,
+    )
+    try:
+        schedule_delete(context, update.effective_message.chat.id, update.effective_message.message_id, 60)
+    except Exception:
+        pass
+
+HISTORY_DAYS = 30
+HISTORY_CONTESTS = 5
+async def konkurs_history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    if not await is_admin(update, context):
+        await auto_clean_reply(update, context, "<i>Tanlovlar tarixini faqat adminlar ko‘rishi mumkin.</i>", skip_delete=False)
+        return
+    days = HISTORY_DAYS
+    if context.args and context.args[0].isdigit():
+        days = max(1, min(int(context.args[0]), 3660))
+    since = int(now_utc().timestamp()) - days * 86400
+    records = STORAGE.archived_contests(chat.id, since)
+    lines = [f"<b>Tanlovlar tarixi (so‘nggi {days} kun)</b>", ""]
+    if not records:
+        lines.append("Bu davrda yakunlangan tanlov yo‘q.")
+    for record in reversed(records[-HISTORY_CONTESTS:]):
+        start = record.get("start_ts")
+        period = f"{format_date(start)} – " if start else ""
+        lines.append(
+            f"• {period}{format_date(record['end_ts'])}: {record.get('participants', 0)} ishtirokchi, "
+            f"{record.get('joins', 0)} qo‘shilish"
+        )
+        if record.get("top"):
+            uid, score = record["top"][0]
+            lines.append(f"   🥇 {format_user_mention(uid)} — {score}")
+    daily = joins_by_bucket(records, DAY, since)
+    if daily:
+        lines += ["", "Kunlik qo‘shilishlar (UTC):"]
+        lines += [f"{format_date(ts)}: {joins}" for ts, joins in daily[-14:]]
+    peak = busiest(joins_by_bucket(records, HOUR, since))
+    if peak:
+        peak_hour = datetime.fromtimestamp(peak[0], timezone.utc).strftime("%d.%m.%Y %H:00")
+        lines.append(f"\nEng faol soat: {peak_hour} UTC — {peak[1]}")
+    await auto_clean_reply(update, context, "\n".join(lines), skip_delete=False)
+def format_date(ts: int) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%d.%m.%Y")
+async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await API.call(
+        PRIORITY_REPLY,
+        update.effective_chat.id,
+        update.message.reply_text,
+        "Assalomu alaykum! Bu bot guruhda konkurslarni boshqaradi. /konkurs buyrug'ini ishlatib boshlang.",
+        parse_mode=ParseMode.HTML,
+    )
+
+
+async def konkurs_status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    cs = get_chat_state(chat.id)
+    if not cs.get("active"):
+        msg = await auto_clean_reply(
+            update,
+            context,
+            "<i>Hozircha tanlov yo‘q. Yangi tanlov boshlanishini kuting.</i>",
+            skip_delete=False,  # Enable auto-delete
+        )
+        # Also schedule deletion of the admin's command message (if not already handled)
+        try:
+            schedule_delete(context, update.effective_message.chat.id, update.effective_message.message_id, 60)
+        except Exception:
+            pass
+        return
+    text, keyboard = render_leaderboard_page(chat.id, 1)
+    await auto_clean_reply(
+        update,
+        context,
+        text,
+        skip_delete=True,  # Do not auto-delete leaderboard/status replies
+        reply_markup=keyboard,
+    )
+async def myrank_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    user = update.effective_user
+    if not user or not get_chat_state(chat.id).get("active"):
+        await auto_clean_reply(update, context, "<i>Hozircha tanlov yo‘q. Yangi tanlov boshlanishini kuting.</i>")
+        return
+    index = get_rank_index(chat.id)
+    rank = index.rank(user.id)
+    if rank is None:
+        await auto_clean_reply(
+            update,
+            context,
+            f"{format_user_mention(user.id)}, sizda hali ball yo‘q. Shaxsiy havola: /mylink",
+        )
+        return
+    score = index.score(user.id)
+    lines = [f"{format_user_mention(user.id)}, siz {len(index)} ishtirokchi orasida {rank}-o‘rindasiz ({score} ball)."]
+    if rank > 1:
+        above = index.slice(rank - 2, rank - 1)[0][1]
+        lines.append(f"Keyingi o‘ringa chiqish uchun {above - score + 1} ball kerak.")
+    page = (rank - 1) // LEADERBOARD_PAGE_SIZE + 1
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(f"Sahifa {page}", callback_data=f"lb:{page}")]])
+    await auto_clean_reply(update, context, "\n".join(lines), reply_markup=keyboard)
+def credit_invites(chat_id: int, counts: Dict[int, int], members: List[int] = ()):
+    # counts may be negative for quick departures; scores never drop below 0
+    cs = get_chat_state(chat_id)
+    if not cs["active"] or not counts:
+        return
+    index = get_rank_index(chat_id)
+    changed = {}
+    for inviter_id, count in counts.items():
+        score = index.score(inviter_id) or 0
+        new_score = max(0, score + count)
+        if new_score == score:
+            continue
+        index.set(inviter_id, new_score)  # writes through to cs["scores"]
+        changed[inviter_id] = new_score
+    if changed:
+        SCORE_VERSIONS[str(chat_id)] = SCORE_VERSIONS.get(str(chat_id), 0) + 1
+    joins = sum(count for count in counts.values() if count > 0)
+    if joins:
+        count_joins(cs, int(now_utc().timestamp()), joins)
+    STORAGE.record_scores(chat_id, changed, joins, members)
+def credit_invite(chat_id: int, inviter_id: int, count: int = 1):
+    credit_invites(chat_id, {inviter_id: count})
+# Join bursts: during a raid every NEW_CHAT_MEMBERS message would otherwise
+# cost its own credit write, refresh trigger and delete. Joins are collected
+# per chat for JOIN_BURST_WINDOW seconds and applied in one pass.
+JOIN_BURSTS: Dict[str, Dict] = {}
+def find_inviter(msg, member, cs: Dict):
+    if msg.from_user and msg.from_user.id != member.id:
+        return msg.from_user.id
+    link_url = None
+    try:
+        if getattr(msg, "invite_link", None):
+            link_url = msg.invite_link.invite_link
+    except Exception:
+        link_url = None
+    if link_url and link_url in cs["links"]:
+        return cs["links"][link_url]["creator_id"]
+    return None
+def apply_join_burst(chat_id: int, counts: Dict[int, int], message_ids: List[int], context=None, members: List[int] = ()):
+    cs = get_chat_state(chat_id)
+    credit_invites(chat_id, counts, members)
+    if cs["active"] and counts and context is not None:
+        request_leaderboard_refresh(chat_id, context)  # Update the pinned leaderboard in near real time
+    schedule_deletes(chat_id, message_ids, 0)
+async def join_burst_job(context: ContextTypes.DEFAULT_TYPE):
+    job = getattr(context, "job", None)
+    if not job:
+        return
+    burst = JOIN_BURSTS.pop(str(job.chat_id), None)
+    if burst:
+        apply_join_burst(job.chat_id, burst["counts"], burst["message_ids"], context, burst["members"])
+def flush_join_bursts():
+    for key, burst in list(JOIN_BURSTS.items()):
+        del JOIN_BURSTS[key]
+        apply_join_burst(int(key), burst["counts"], burst["message_ids"], members=burst["members"])
+async def on_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    msg = update.effective_message
+    cs = get_chat_state(chat.id)
+    if not msg or not msg.new_chat_members:
+        return
+    counts: Dict[int, int] = {}
+    members = []
+    for member in msg.new_chat_members:
+        inviter_id = find_inviter(msg, member, cs)
+        if inviter_id is not None and claim_member(chat.id, cs, member.id, inviter_id):
+            counts[inviter_id] = counts.get(inviter_id, 0) + 1
+            members.append(member.id)
+    queue_join_credits(chat.id, counts, [msg.message_id], context, members)
+def queue_join_credits(
+    chat_id: int,
+    counts: Dict[int, int],
+    message_ids: List[int],
+    context: ContextTypes.DEFAULT_TYPE,
+    members: List[int] = (),
+):
+    if JOIN_BURST_WINDOW <= 0:
+        apply_join_burst(chat_id, counts, message_ids, context, members)
+        return
+    key = str(chat_id)
+    burst = JOIN_BURSTS.get(key)
+    if burst is None:
+        burst = JOIN_BURSTS[key] = {"counts": {}, "message_ids": [], "members": []}
+        context.job_queue.run_once(join_burst_job, when=JOIN_BURST_WINDOW, chat_id=chat_id, name=f"joins_{chat_id}")
+    for inviter_id, count in counts.items():
+        burst["counts"][inviter_id] = burst["counts"].get(inviter_id, 0) + count
+    burst["message_ids"].extend(message_ids)
+    burst["members"].extend(members)
+# Anti-farming: cs["credited"] holds every member that already earned their
+# inviter a point this contest, so leaving and rejoining earns nothing. With
+# QUICK_LEAVE_SECONDS set, a member who leaves that soon after joining also
+# takes the point back; recent joins are kept per chat only for that long.
+RECENT_JOINS: Dict[str, OrderedDict] = {}
+def claim_member(chat_id: int, cs: Dict, member_id: int, inviter_id: int) -> bool:
+    if not cs["active"] or not cs["credited"].add(member_id):
+        return False
+    if QUICK_LEAVE_SECONDS > 0:
+        recent = RECENT_JOINS.setdefault(str(chat_id), OrderedDict())
+        now = now_utc().timestamp()
+        recent[member_id] = (inviter_id, now)
+        while now - next(iter(recent.values()))[1] > QUICK_LEAVE_SECONDS:
+            recent.popitem(last=False)
+    return True
+def debit_quick_leave(chat_id: int, member_id: int, context: ContextTypes.DEFAULT_TYPE):
+    recent = RECENT_JOINS.get(str(chat_id))
+    entry = recent.pop(member_id, None) if recent else None
+    if entry and now_utc().timestamp() - entry[1] <= QUICK_LEAVE_SECONDS:
+        queue_join_credits(chat_id, {entry[0]: -1}, [], context)
+# Personal invite links: one create_chat_invite_link per user per contest.
+# cs["user_links"] maps user id to that link, and concurrent /mylink calls
+# from the same user share one in-flight creation.
+USER_LINK_FETCHES: Dict[Tuple[str, int], asyncio.Future] = {}
+async def get_user_link(chat_id: int, user_id: int, context: ContextTypes.DEFAULT_TYPE) -> str:
+    cs = get_chat_state(chat_id)
+    links = cs["links"]
+    user_links = cs.setdefault("user_links", {})
+    link_url = user_links.get(str(user_id))
+    if link_url:
+        return link_url
+    key = (str(chat_id), user_id)
+    pending = USER_LINK_FETCHES.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    future = asyncio.get_running_loop().create_future()
+    USER_LINK_FETCHES[key] = future
+    try:
+        link = await API.call(
+            PRIORITY_REPLY,
+            None,
+            context.bot.create_chat_invite_link,
+            chat_id=chat_id,
+            name=f"user_{user_id}"[:32],
+        )
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # waiters re-raise it; don't warn about it here
+        raise
+    finally:
+        del USER_LINK_FETCHES[key]
+    meta = {"creator_id": user_id, "revoked": False}
+    links[link.invite_link] = meta
+    user_links[str(user_id)] = link.invite_link
+    if cs["links"] is links:
+        STORAGE.record_link(chat_id, link.invite_link, meta)
+    future.set_result(link.invite_link)
+    return link.invite_link
+async def mylink_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    user = update.effective_user
+    if not user or not get_chat_state(chat.id).get("active"):
+        await auto_clean_reply(update, context, "<i>Hozircha tanlov yo‘q. Yangi tanlov boshlanishini kuting.</i>")
+        return
+    try:
+        link_url = await get_user_link(chat.id, user.id, context)
+    except Exception:
+        await auto_clean_reply(update, context, "<i>Havola yaratib bo‘lmadi. Bot admin ekanini tekshiring.</i>")
+        return
+    await auto_clean_reply(
+        update,
+        context,
+        f"{format_user_mention(user.id)}, sizning shaxsiy havolangiz:\n{link_url}\n\n"
+        "<i>Ushbu xabar 1 daqiqadan so‘ng o‘chiriladi.</i>",
+    )
+
+
+async def cleanup_system_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.effective_message
+    if not msg:
+        return
+
+    should_delete = False
+    if msg.left_chat_member:
+        should_delete = True
+        debit_quick_leave(msg.chat_id, msg.left_chat_member.id, context)
+    if msg.pinned_message:
+        should_delete = True
+    if msg.new_chat_title:
+        should_delete = True
+    if msg.new_chat_photo or msg.delete_chat_photo:
+        should_delete = True
+
+    if should_delete:
+        schedule_delete(context, msg.chat_id, msg.message_id, 0)
+
+async def dev_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = (
+        "<b>Just remove</b>\n"
+        "Bu bot guruhda konkurs o`tkazishi,hamda shu bilan birgalikda barcha tizim habarlarini\n Masalan Guruhga qo`shildi, Guruhni tark etdi, Habar qadaldi va hokazolardan ham tozalab turadi.\n"
+        "Adminlar konkursni boshlashi mumkin.\n"
+        "\n"
+        "Bot dasturchisi: <b>@xoqon2003</b>"
+    )
+    await auto_clean_reply(update, context, text)
+
+    
+def is_cleanup_update(update: object) -> bool:
+    # service messages that cleanup_system_messages would only delete
+    msg = update.effective_message if isinstance(update, Update) else None
+    if not msg or msg.new_chat_members:
+        return False
+    return bool(
+        msg.left_chat_member
+        or msg.pinned_message
+        or msg.new_chat_title
+        or msg.new_chat_photo
+        or msg.delete_chat_photo
+    )
+def build_application(builder: ApplicationBuilder) -> Application:
+    if CONCURRENT_UPDATES > 0:
+        builder = builder.concurrent_updates(
+            ChatOrderedUpdateProcessor(CONCURRENT_UPDATES, UPDATE_SHED_THRESHOLD, is_cleanup_update)
+        )
+    if BOT_API_BASE_URL:
+        # e.g. a local Bot API server, or the fake one loadtest.py serves
+        builder = builder.base_url(BOT_API_BASE_URL)
+    app = builder.token(BOT_TOKEN).post_init(on_startup).post_shutdown(on_shutdown).build()
+    app.add_handler(TypeHandler(Update, time_handler(remember_profiles)), group=-1)
+    app.add_handler(CommandHandler("start", time_handler(start_cmd)))
+    app.add_handler(CommandHandler("konkurs", time_handler(konkurs_cmd)))
+    app.add_handler(CommandHandler("konkurs_stop", time_handler(konkurs_stop_cmd)))
+    app.add_handler(CommandHandler("konkurs_status", time_handler(konkurs_status_cmd)))
+    app.add_handler(CommandHandler("mylink", time_handler(mylink_cmd)))
+    app.add_handler(CommandHandler("konkurs_history", time_handler(konkurs_history_cmd)))
+    app.add_handler(CommandHandler("myrank", time_handler(myrank_cmd)))
+    app.add_handler(CallbackQueryHandler(time_handler(leaderboard_page_callback), pattern=r"^lb:"))
+    app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, time_handler(on_new_members)))
+    app.add_handler(ChatMemberHandler(time_handler(on_chat_member), ChatMemberHandler.CHAT_MEMBER))
+    sys_cleanup_filter = (
+        filters.StatusUpdate.LEFT_CHAT_MEMBER
+        | filters.StatusUpdate.PINNED_MESSAGE
+        | filters.StatusUpdate.NEW_CHAT_TITLE
+        | filters.StatusUpdate.NEW_CHAT_PHOTO
+        | filters.StatusUpdate.DELETE_CHAT_PHOTO
+    )
+    app.add_handler(MessageHandler(sys_cleanup_filter, time_handler(cleanup_system_messages)))
+    # Allow /dev for everyone (no admin check)
+    app.add_handler(CommandHandler("dev", time_handler(dev_cmd), block=False))
+    app.job_queue.run_repeating(flush_state_job, interval=STATE_FLUSH_INTERVAL, first=STATE_FLUSH_INTERVAL, name="flush_state")
+    app.job_queue.run_repeating(scheduler_tick, interval=SCHEDULER_TICK, first=0, name="scheduler_tick")
+    return app
+def main():
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN not set in environment")
+    run_application(build_application(ApplicationBuilder()))
+if __name__ == "__main__":
     main()
\ No newline at end of file
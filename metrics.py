@@ -0,0 +1,160 @@
+import os
+import time
+import asyncio
+import functools
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+load_dotenv()
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0").lower() in ("1", "true", "yes")
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+METRICS_TOP_CHATS = int(os.getenv("METRICS_TOP_CHATS", "10"))
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+class Metric:
+    kind = "untyped"
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = labels
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+class Counter(Metric):
+    kind = "counter"
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self.values: Dict[Tuple, float] = {}
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+    def render(self) -> List[str]:
+        return self.header() + [
+            f"{self.name}{_labels(self.label_names, labels)} {value}" for labels, value in self.values.items()
+        ]
+class Gauge(Counter):
+    kind = "gauge"
+    def set(self, *labels, value: float):
+        self.values[labels] = value
+    def clear(self):
+        self.values.clear()
+class Histogram(Metric):
+    kind = "histogram"
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        # per label set: [per-bucket counts (last one is +Inf), sum]
+        self.series: Dict[Tuple, list] = {}
+    def observe(self, *labels, value: float):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+    def render(self) -> List[str]:
+        lines = self.header()
+        for labels, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {cumulative}")
+        return lines
+class Registry:
+    # Metrics are plain in-process dicts updated inline; collectors run at
+    # scrape time to refresh gauges that are cheaper to read than to track.
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: List[Callable[[], None]] = []
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.add(Counter(name, help_text, labels))
+    def gauge(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Gauge:
+        return self.add(Gauge(name, help_text, labels))
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help_text, labels, buckets))
+    def collector(self, fn: Callable[[], None]):
+        self.collectors.append(fn)
+        return fn
+    def render(self) -> str:
+        for collect in self.collectors:
+            collect()
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+REGISTRY = Registry()
+HANDLER_SECONDS = REGISTRY.histogram("bot_handler_seconds", "Update handler latency", ("handler",))
+HANDLER_ERRORS = REGISTRY.counter("bot_handler_errors_total", "Update handlers that raised", ("handler", "error"))
+API_CALLS = REGISTRY.counter(
+    "bot_api_calls_total", "Outbound Bot API calls by outcome (ok, RetryAfter or the error class)", ("method", "outcome")
+)
+API_SECONDS = REGISTRY.histogram("bot_api_call_seconds", "Outbound Bot API call latency", ("method",))
+API_CHAT_CALLS = REGISTRY.gauge("bot_api_chat_calls", "Outbound Bot API calls of the busiest chats", ("chat",))
+API_QUEUE_DEPTH = REGISTRY.gauge("bot_api_queue_depth", "Calls waiting in the dispatcher", ("priority",))
+API_PARKED = REGISTRY.gauge("bot_api_parked_calls", "Calls parked until their chat has a token")
+STATE_FLUSH_SECONDS = REGISTRY.histogram("bot_state_flush_seconds", "Duration of state flushes", ("backend",))
+STATE_FLUSH_BYTES = REGISTRY.counter("bot_state_flush_bytes_total", "Bytes written by state flushes", ("backend",))
+ACTIVE_CHATS = REGISTRY.gauge("bot_active_chats", "Loaded chats with a running contest")
+RESIDENT_CHATS = REGISTRY.gauge("bot_resident_chats", "Chat states held in memory")
+PARTICIPANTS = REGISTRY.gauge("bot_participants", "Participants across running contests")
+SCHEDULER_EVENTS = REGISTRY.counter("bot_scheduler_events_total", "Work done by the scheduler tick", ("event",))
+SCHEDULED = REGISTRY.gauge("bot_scheduled", "Pending scheduler entries", ("queue",))
+def time_handler(callback):
+    # Handler wrapper recording latency and failures; handlers are left
+    # untouched when metrics are disabled.
+    if not METRICS_ENABLED:
+        return callback
+    name = callback.__name__
+    @functools.wraps(callback)
+    async def timed(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception as e:
+            HANDLER_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(name, value=time.perf_counter() - started)
+    return timed
+def top_items(counts: Dict, n: int) -> List[Tuple]:
+    return sorted(counts.items(), key=lambda kv: -kv[1])[:n]
+async def _serve_scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[1].split(b"?")[0] == b"/metrics":
+            status, body = "200 OK", REGISTRY.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+SERVER: Optional[asyncio.AbstractServer] = None
+async def start_server():
+    global SERVER
+    if METRICS_ENABLED and SERVER is None:
+        SERVER = await asyncio.start_server(_serve_scrape, METRICS_LISTEN, METRICS_PORT)
+async def stop_server():
+    global SERVER
+    if SERVER is not None:
+        SERVER.close()
+        await SERVER.wait_closed()
+        SERVER = None
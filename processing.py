@@ -0,0 +1,58 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+# Admission into do_process_update is left unbounded so updates reach it in
+# arrival order without waiting; real concurrency is bounded by the pool below.
+UNBOUNDED = 2 ** 30
+def update_chat_key(update: object):
+    if isinstance(update, Update):
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+    return None
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    # Processes updates for different chats concurrently on a bounded pool,
+    # while updates for the same chat run strictly one after another: each
+    # update waits for the previous one of its chat before taking a pool slot.
+    # Once more than shed_threshold updates are waiting, updates matching
+    # is_low_value are dropped instead of queued.
+    def __init__(self, workers: int, shed_threshold: int, is_low_value: Callable[[object], bool]):
+        super().__init__(UNBOUNDED)
+        self.pool = asyncio.BoundedSemaphore(workers)
+        self.shed_threshold = shed_threshold
+        self.is_low_value = is_low_value
+        self.tails: Dict[Any, asyncio.Future] = {}
+        self.waiting = 0
+        self.shed = 0
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        if self.waiting >= self.shed_threshold and self.is_low_value(update):
+            self.shed += 1
+            coroutine.close()
+            return
+        key = update_chat_key(update)
+        previous = self.tails.get(key)
+        done = asyncio.get_running_loop().create_future()
+        self.tails[key] = done
+        self.waiting += 1
+        try:
+            try:
+                if previous is not None:
+                    await previous
+                await self.pool.acquire()
+            finally:
+                self.waiting -= 1
+            try:
+                await coroutine
+            finally:
+                self.pool.release()
+        finally:
+            if not done.done():
+                done.set_result(None)
+            if self.tails.get(key) is done:
+                del self.tails[key]
+    async def initialize(self):
+        pass
+    async def shutdown(self):
+        pass
@@ -0,0 +1,48 @@
+import html
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+MAX_NAME_LENGTH = 64
+class ProfileCache:
+    # Display names of recently seen users, least recently used first. Names
+    # come from the User objects updates already carry and are HTML-escaped
+    # once here, so rendering a mention is a dict lookup. New or changed
+    # names are collected until the next flush persists them.
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.names: "OrderedDict[int, str]" = OrderedDict()
+        self.changes: Dict[int, str] = {}
+    def __len__(self) -> int:
+        return len(self.names)
+    def load(self, items: Iterable[Tuple[int, str]]):
+        # items oldest first, as load_profiles() returns them
+        for user_id, name in items:
+            self.names[user_id] = name
+            self.names.move_to_end(user_id)
+        self._trim()
+    def get(self, user_id: int) -> Optional[str]:
+        name = self.names.get(user_id)
+        if name is not None:
+            self.names.move_to_end(user_id)
+        return name
+    def remember(self, user):
+        if user is None or user.is_bot:
+            return
+        name = html.escape((user.full_name or user.username or "").strip()[:MAX_NAME_LENGTH])
+        if not name:
+            return
+        if self.names.get(user.id) == name:
+            self.names.move_to_end(user.id)
+            return
+        self.names[user.id] = name
+        self.names.move_to_end(user.id)
+        self.changes[user.id] = name
+        self._trim()
+    def _trim(self):
+        while len(self.names) > self.capacity:
+            user_id, _ = self.names.popitem(last=False)
+            self.changes.pop(user_id, None)
+    def take_changes(self) -> Dict[int, str]:
+        changes, self.changes = self.changes, {}
+        return changes
+    def items(self):
+        return self.names.items()
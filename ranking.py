@@ -0,0 +1,122 @@
+from array import array
+from bisect import bisect_left, insort
+from typing import Dict, Iterator, List, Optional, Tuple
+from scores import ScoreTable
+class RankIndex:
+    # Leaderboard order kept incrementally: users are bucketed by score (each
+    # bucket an int64 array sorted by user id, matching the (-score, user_id)
+    # order), and a Fenwick tree over score values counts users per score, so
+    # rank lookups and slices cost O(log n) instead of re-sorting every score.
+    # The index owns updates to its source table: set() writes through to it.
+    def __init__(self, scores: Optional[ScoreTable] = None):
+        self.source = scores if scores is not None else ScoreTable()
+        self.buckets: Dict[int, array] = {}
+        self.levels: List[int] = []
+        self.tree: List[int] = [0] * 65
+        self.total = 0
+        # items() is in user id order, so every bucket comes out sorted
+        for user_id, score in self.source.items():
+            bucket = self.buckets.get(score)
+            if bucket is None:
+                bucket = self.buckets[score] = array("q")
+            bucket.append(user_id)
+            self.total += 1
+        self.levels = sorted(self.buckets)
+        if self.levels:
+            self._grow(self.levels[-1])
+    def __len__(self) -> int:
+        return self.total
+    def _grow(self, score: int):
+        size = len(self.tree) - 1
+        while score + 1 > size:
+            size *= 2
+        tree = [0] * (size + 1)
+        for level in self.levels:
+            i = level + 1
+            count = len(self.buckets[level])
+            while i <= size:
+                tree[i] += count
+                i += i & -i
+        self.tree = tree
+    def _add(self, score: int, delta: int):
+        i = score + 1
+        size = len(self.tree) - 1
+        while i <= size:
+            self.tree[i] += delta
+            i += i & -i
+    def _prefix(self, score: int) -> int:
+        # number of users with a score <= score
+        i = min(score + 1, len(self.tree) - 1)
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+    def _lower_bound(self, target: int) -> int:
+        # smallest score whose prefix count reaches target
+        pos = 0
+        size = len(self.tree) - 1
+        step = 1 << (size.bit_length() - 1)
+        while step:
+            nxt = pos + step
+            if nxt <= size and self.tree[nxt] < target:
+                pos = nxt
+                target -= self.tree[nxt]
+            step >>= 1
+        return pos
+    def set(self, user_id: int, score: int):
+        score = max(0, score)
+        old = self.source.get(user_id)
+        if old == score:
+            return
+        self.source[user_id] = score
+        if old is not None:
+            bucket = self.buckets[old]
+            del bucket[bisect_left(bucket, user_id)]
+            if not bucket:
+                del self.buckets[old]
+                del self.levels[bisect_left(self.levels, old)]
+            self._add(old, -1)
+            self.total -= 1
+        if score + 1 >= len(self.tree):
+            self._grow(score)
+        bucket = self.buckets.get(score)
+        if bucket is None:
+            bucket = self.buckets[score] = array("q")
+            insort(self.levels, score)
+        insort(bucket, user_id)
+        self._add(score, 1)
+        self.total += 1
+    def score(self, user_id: int) -> Optional[int]:
+        return self.source.get(user_id)
+    def rank(self, user_id: int) -> Optional[int]:
+        score = self.source.get(user_id)
+        if score is None:
+            return None
+        above = self.total - self._prefix(score)
+        return above + bisect_left(self.buckets[score], user_id) + 1
+    def iter_from(self, start: int) -> Iterator[Tuple[int, int]]:
+        # yields (user_id, score) in leaderboard order from 0-based position start
+        if start >= self.total:
+            return
+        score = self._lower_bound(self.total - start)
+        offset = start - (self.total - self._prefix(score))
+        li = bisect_left(self.levels, score)
+        while li >= 0:
+            level = self.levels[li]
+            bucket = self.buckets[level]
+            for i in range(offset, len(bucket)):
+                yield bucket[i], level
+            offset = 0
+            li -= 1
+    def slice(self, start: int, stop: int) -> List[Tuple[int, int]]:
+        result = []
+        if stop <= start:
+            return result
+        for item in self.iter_from(start):
+            result.append(item)
+            if len(result) >= stop - start:
+                break
+        return result
+    def top(self, k: int) -> List[Tuple[int, int]]:
+        return self.slice(0, k)
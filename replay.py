@@ -0,0 +1,296 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import types
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional
+# Offline replay: feeds recorded Update JSON (one object per line, as
+# getUpdates returns them) through the bot's own handlers with a stub Bot
+# API, rebuilds contest state on a clock driven by the updates' dates and
+# diffs the result against a saved contest_state.json:
+#   python replay.py updates.jsonl --expect contest_state.json
+#   python replay.py updates.jsonl --out replayed_state.json
+# --out also writes the replayed archive next to the state file.
+# Joins, leaves and chat_member updates reach the handlers as plain
+# attribute objects built while the JSON is decoded, rather than decoded
+# telegram objects, which would cost several times the handler itself;
+# commands are decoded in full. Join bursts, contest ends and the link
+# revocations that archive ended contests run each time the update clock
+# moves on a second. Ended contests are diffed against the archive kept
+# next to the expected state file, live ones against the state itself.
+class StubBot:
+    # stands in for context.bot; calls never reach it, see ReplayApi
+    def __getattr__(self, name):
+        async def method(*args, **kwargs):
+            return True
+        method.__name__ = name
+        return method
+class ReplayApi:
+    # Drop-in for the ApiDispatcher: answers every call at once with just
+    # enough of a result for the handlers to carry on, without sending it.
+    def __init__(self):
+        self.calls: Dict[str, int] = {}
+        self.chat_calls: Dict[int, int] = {}
+        self.next_id = 0
+    def start(self):
+        pass
+    async def stop(self):
+        pass
+    def stats(self) -> Dict:
+        return {"queue_depth": {}, "parked": 0}
+    def submit(self, priority: int, chat_id, method, /, *args, **kwargs) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(self.answer(chat_id, method, kwargs))
+        return future
+    async def call(self, priority: int, chat_id, method, /, *args, **kwargs):
+        return self.answer(chat_id, method, kwargs)
+    def answer(self, chat_id, method, kwargs: Dict):
+        name = getattr(method, "__name__", "")
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.next_id += 1
+        if name in ("send_message", "reply_text"):
+            chat = kwargs.get("chat_id", chat_id)
+            return types.SimpleNamespace(message_id=self.next_id, chat=types.SimpleNamespace(id=chat), chat_id=chat)
+        if name == "create_chat_invite_link":
+            return types.SimpleNamespace(invite_link=f"https://t.me/+replay{self.next_id}", creator=None)
+        if name == "get_chat_administrators":
+            return []
+        return True
+class Record:
+    # One object of an update. The decoder hands over each parsed dict as
+    # the instance dict, so reading a field is a plain attribute lookup;
+    # fields the update lacks read as None, as on telegram objects.
+    def __getattr__(self, name):
+        return None
+    @property
+    def effective_message(self):
+        return self.message
+    @property
+    def effective_chat(self):
+        event = self.message or self.chat_member
+        return event.chat if event else None
+    @property
+    def effective_user(self):
+        event = self.message or self.chat_member
+        return event.from_user if event else None
+    @property
+    def chat_id(self):
+        return self.chat.id if self.chat else None
+def as_record(data: Dict) -> Record:
+    record = Record.__new__(Record)
+    if "from" in data:
+        data["from_user"] = data.pop("from")
+    record.__dict__ = data
+    return record
+DECODER = json.JSONDecoder(object_hook=as_record)
+# service messages the bot's cleanup handler takes
+CLEANUP_FIELDS = ("left_chat_member", "pinned_message", "new_chat_title", "new_chat_photo", "delete_chat_photo")
+class ReplayJobQueue:
+    # leaderboard edits and join bursts have no effect on the rebuilt state
+    def run_once(self, callback, when, chat_id=None, name=None, data=None):
+        return None
+    def run_repeating(self, *args, **kwargs):
+        return None
+class ReplayApplication:
+    def __init__(self):
+        self.tasks: List = []
+    def create_task(self, coroutine):
+        self.tasks.append(coroutine)
+def command_of(text: Optional[str]) -> Optional[str]:
+    if not text or not text.startswith("/"):
+        return None
+    return text.split(None, 1)[0][1:].split("@", 1)[0].lower()
+def read_updates(path: str) -> Iterator[str]:
+    f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    try:
+        for line in f:
+            if line.strip():
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+async def run_due_work(bot, context, application: ReplayApplication):
+    # join bursts, contest ends, due deletes and link revocations, as the
+    # bot's jobs and background tasks would run them
+    bot.flush_join_bursts()
+    await bot.scheduler_tick(context)
+    for task in application.tasks:
+        await task
+    application.tasks.clear()
+    if bot.REVOCATIONS:
+        await asyncio.gather(*list(bot.REVOCATIONS.values()))
+async def replay(bot, lines: Iterator[str], trust_commands: bool) -> Dict:
+    from telegram import Update
+    api = bot.API = ReplayApi()
+    application = ReplayApplication()
+    context = types.SimpleNamespace(bot=StubBot(), job_queue=ReplayJobQueue(), application=application, args=[])
+    now = [datetime.fromtimestamp(0, timezone.utc)]
+    bot.now_utc = lambda: now[0]
+    commands = {"konkurs": bot.konkurs_cmd, "konkurs_stop": bot.konkurs_stop_cmd}
+    on_new_members, on_chat_member, cleanup = bot.on_new_members, bot.on_chat_member, bot.cleanup_system_messages
+    counts = {"updates": 0, "dispatched": 0, "first_date": None, "last_date": None}
+    clock = 0
+    decode = DECODER.decode
+    for line in lines:
+        counts["updates"] += 1
+        update = decode(line)
+        message = update.message
+        event = message or update.chat_member
+        if event is None:
+            continue
+        if event.date and event.date > clock:
+            clock = event.date
+            if counts["first_date"] is None:
+                counts["first_date"] = clock
+            now[0] = datetime.fromtimestamp(clock, timezone.utc)
+            await run_due_work(bot, context, application)
+        counts["dispatched"] += 1
+        if message is None:
+            await on_chat_member(update, context)
+        elif message.new_chat_members:
+            await on_new_members(update, context)
+        elif any(message.__dict__.get(field) for field in CLEANUP_FIELDS):
+            await cleanup(update, context)
+        elif command_of(message.text) in commands:
+            data = json.loads(line)
+            context.args = message.text.split()[1:]
+            sender = message.from_user.id if message.from_user else None
+            if trust_commands and sender is not None:
+                # admin lists were not recorded; the sender was allowed then
+                key = str(message.chat.id)
+                cached = bot.ADMINS.get(key)
+                admins = cached[1] if cached else set()
+                admins.add(sender)
+                bot.ADMINS[key] = (float("inf"), admins)
+            await commands[command_of(message.text)](Update.de_json(data, None), context)
+        else:
+            counts["dispatched"] -= 1
+    await run_due_work(bot, context, application)
+    counts["last_date"] = clock or None
+    counts["api_calls"] = dict(sorted(api.calls.items()))
+    return counts
+def load_expected(path: str) -> Dict:
+    from storage import decode_chat
+    with open(path, "r", encoding="utf-8") as f:
+        state = json.load(f)
+    state.pop("_seq", None)
+    state.pop("_resident", None)
+    return {key: decode_chat(cs) for key, cs in state.items()}
+def diff_scores(entry: Dict, got_scores: Dict, want_scores: Dict, limit: int):
+    users = [u for u in set(got_scores) | set(want_scores) if got_scores.get(u) != want_scores.get(u)]
+    if users:
+        entry["score_diffs"] = len(users)
+        entry["scores"] = {u: [got_scores.get(u), want_scores.get(u)] for u in sorted(users, key=int)[:limit]}
+def diff_states(replayed: Dict, expected: Dict, end_slack: int, limit: int) -> List[Dict]:
+    diffs = []
+    for key in sorted(set(replayed) | set(expected), key=int):
+        got, want = replayed.get(key), expected.get(key)
+        got_scores = got["scores"].to_dict() if got else {}
+        want_scores = want["scores"].to_dict() if want else {}
+        if not got_scores and not want_scores and not (got or {}).get("active") and not (want or {}).get("active"):
+            continue
+        entry: Dict = {"chat": key}
+        if got is None or want is None:
+            entry["missing"] = "replayed" if got is None else "expected"
+        else:
+            if bool(got.get("active")) != bool(want.get("active")):
+                entry["active"] = [bool(got.get("active")), bool(want.get("active"))]
+            if abs(int(got.get("end_ts") or 0) - int(want.get("end_ts") or 0)) > end_slack:
+                entry["end_ts"] = [got.get("end_ts"), want.get("end_ts")]
+        diff_scores(entry, got_scores, want_scores, limit)
+        if len(entry) > 1:
+            diffs.append(entry)
+    return diffs
+def diff_archives(replayed: List[Dict], expected: List[Dict], end_slack: int, limit: int) -> List[Dict]:
+    # contests pair up by chat and an end_ts within end_slack of each other
+    from scores import ScoreTable
+    diffs = []
+    unmatched = list(expected)
+    for got in replayed:
+        want = next(
+            (r for r in unmatched if r["chat"] == got["chat"] and abs(r["end_ts"] - got["end_ts"]) <= end_slack),
+            None,
+        )
+        entry: Dict = {"chat": got["chat"], "end_ts": got["end_ts"]}
+        if want is None:
+            entry["missing"] = "expected"
+        else:
+            unmatched.remove(want)
+            diff_scores(
+                entry,
+                ScoreTable.from_json(got.get("scores")).to_dict(),
+                ScoreTable.from_json(want.get("scores")).to_dict(),
+                limit,
+            )
+        if len(entry) > 2:
+            diffs.append(entry)
+    diffs += [{"chat": r["chat"], "end_ts": r["end_ts"], "missing": "replayed"} for r in unmatched]
+    return sorted(diffs, key=lambda d: (int(d["chat"]), d["end_ts"]))
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Replay recorded updates offline and diff the rebuilt contest state.")
+    parser.add_argument("updates", help="JSON-lines file of Update objects, or - for stdin")
+    parser.add_argument("--expect", help="contest_state.json to diff the rebuilt state against")
+    parser.add_argument("--out", help="write the rebuilt state here, in contest_state.json format")
+    parser.add_argument("--end-slack", type=int, default=60, help="seconds end_ts may differ by")
+    parser.add_argument("--limit", type=int, default=20, help="score differences listed per chat")
+    parser.add_argument(
+        "--check-admins", action="store_true", help="apply admin checks instead of trusting recorded commands"
+    )
+    args = parser.parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="contest-replay-")
+    # main loads state at import time, so point it at an empty scratch dir first
+    os.environ.update({
+        "STATE_FILE": os.path.join(workdir, "contest_state.json"),
+        "EVENT_LOG_FILE": os.path.join(workdir, "contest_events.log"),
+        "STORAGE_BACKEND": "json",
+        "JOIN_BURST_WINDOW": "1",
+        "METRICS_ENABLED": "0",
+        # every chat must stay resident to be diffed
+        "CHAT_CACHE_SIZE": str(1 << 62),
+    })
+    try:
+        import main as bot
+        started = time.perf_counter()
+        report = asyncio.run(replay(bot, read_updates(args.updates), not args.check_admins))
+        elapsed = time.perf_counter() - started
+        report["seconds"] = round(elapsed, 3)
+        report["updates_per_sec"] = round(report["updates"] / elapsed) if elapsed else None
+        state = dict(bot.STATE)
+        if args.out:
+            bot.write_json_atomic(args.out, [(key, bot.dump_chat(cs)) for key, cs in state.items()])
+            # with its archive alongside, the output can serve as --expect later
+            if os.path.exists(bot.STORAGE.archive_path):
+                shutil.copyfile(bot.STORAGE.archive_path, bot.JsonStorage(args.out, os.devnull).archive_path)
+        status = 0
+        if args.expect:
+            diffs = diff_states(state, load_expected(args.expect), args.end_slack, args.limit)
+            report["chats_differing"] = len(diffs)
+            report["diffs"] = diffs
+            expected_archive = bot.JsonStorage(args.expect, os.devnull)
+            if os.path.exists(expected_archive.archive_path):
+                # contests archived before the recording started are not in it
+                since = (report["first_date"] or 0) - args.end_slack
+                archive_diffs = diff_archives(
+                    bot.STORAGE.archived_contests(since=since),
+                    expected_archive.archived_contests(since=since),
+                    args.end_slack,
+                    args.limit,
+                )
+                report["contests_differing"] = len(archive_diffs)
+                report["archive_diffs"] = archive_diffs
+                diffs = diffs + archive_diffs
+            else:
+                report["archive_diffs"] = None
+            status = 1 if diffs else 0
+        bot.STORAGE.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    return status
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
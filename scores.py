@@ -0,0 +1,214 @@
+import os
+import sys
+import math
+import zlib
+import base64
+import operator
+import itertools
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+from dotenv import load_dotenv
+load_dotenv()
+CREDITED_EXACT_LIMIT = int(os.getenv("CREDITED_EXACT_LIMIT", "50000"))
+CREDITED_BLOOM_CAPACITY = int(os.getenv("CREDITED_BLOOM_CAPACITY", "2000000"))
+CREDITED_BLOOM_ERROR = 0.01
+MASK64 = (1 << 64) - 1
+def _pack(column: array, delta: bool = False) -> str:
+    if delta and column:
+        # sorted ids become small gaps, which deflate far better
+        column = array("q", itertools.chain((column[0],), map(operator.sub, column[1:], column[:-1])))
+    if sys.byteorder == "big":
+        column = array("q", column)
+        column.byteswap()
+    return base64.b64encode(zlib.compress(column.tobytes(), 1)).decode("ascii")
+def _unpack(data: str, delta: bool = False) -> array:
+    column = array("q")
+    column.frombytes(zlib.decompress(base64.b64decode(data)))
+    if sys.byteorder == "big":
+        column.byteswap()
+    if delta:
+        column = array("q", itertools.accumulate(column))
+    return column
+class ScoreTable:
+    # Scores of one contest keyed by integer user id: two parallel int64
+    # columns sorted by user id, looked up by bisection. New participants go
+    # to a small pending dict that is merged into the columns once it grows
+    # past 1/64th of them, so inserts stay cheap without a per-user dict.
+    # On disk each column is deflated little-endian int64 in base64, with the
+    # ids stored as gaps from the previous id.
+    __slots__ = ("ids", "values", "pending")
+    def __init__(self, ids: Optional[array] = None, values: Optional[array] = None):
+        self.ids = ids if ids is not None else array("q")
+        self.values = values if values is not None else array("q")
+        self.pending: Dict[int, int] = {}
+    def __len__(self) -> int:
+        return len(self.ids) + len(self.pending)
+    def _find(self, user_id: int) -> int:
+        ids = self.ids
+        i = bisect_left(ids, user_id)
+        if i < len(ids) and ids[i] == user_id:
+            return i
+        return -1
+    def get(self, user_id: int, default=None):
+        i = self._find(user_id)
+        if i >= 0:
+            return self.values[i]
+        return self.pending.get(user_id, default)
+    def __contains__(self, user_id: int) -> bool:
+        return self._find(user_id) >= 0 or user_id in self.pending
+    def __getitem__(self, user_id: int) -> int:
+        score = self.get(user_id)
+        if score is None:
+            raise KeyError(user_id)
+        return score
+    def __setitem__(self, user_id: int, score: int):
+        i = self._find(user_id)
+        if i >= 0:
+            self.values[i] = score
+            return
+        self.pending[user_id] = score
+        if len(self.pending) > max(256, len(self.ids) >> 6):
+            self._merge()
+    def _merge(self):
+        if not self.pending:
+            return
+        ids, values = self.ids, self.values
+        new_ids, new_values = array("q"), array("q")
+        start = 0
+        for user_id, score in sorted(self.pending.items()):
+            i = bisect_left(ids, user_id, start)
+            new_ids.extend(ids[start:i])
+            new_values.extend(values[start:i])
+            new_ids.append(user_id)
+            new_values.append(score)
+            start = i
+        new_ids.extend(ids[start:])
+        new_values.extend(values[start:])
+        self.ids, self.values = new_ids, new_values
+        self.pending = {}
+    def update(self, scores):
+        # accepts a mapping or (user_id, score) pairs; keys may be strings
+        # as they come back from JSON
+        items = scores.items() if hasattr(scores, "items") else scores
+        for user_id, score in items:
+            self[int(user_id)] = score
+    def items(self) -> Iterator[Tuple[int, int]]:
+        self._merge()
+        return zip(self.ids, self.values)
+    def to_dict(self) -> Dict[str, int]:
+        return {str(user_id): score for user_id, score in self.items()}
+    def to_json(self) -> Dict[str, str]:
+        self._merge()
+        return {"ids": _pack(self.ids, delta=True), "scores": _pack(self.values)}
+    @classmethod
+    def from_json(cls, data) -> "ScoreTable":
+        if isinstance(data, ScoreTable):
+            return data
+        if isinstance(data, dict) and isinstance(data.get("ids"), str):
+            return cls(_unpack(data["ids"], delta=True), _unpack(data["scores"]))
+        # legacy {"<user id>": score} mapping
+        return cls.from_pairs(sorted((int(user_key), score) for user_key, score in (data or {}).items()))
+    @classmethod
+    def from_pairs(cls, pairs: Iterable[Tuple[int, int]]) -> "ScoreTable":
+        # pairs must already be sorted by user id
+        table = cls()
+        for user_id, score in pairs:
+            table.ids.append(user_id)
+            table.values.append(score)
+        return table
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, ScoreTable):
+            return NotImplemented
+        return list(self.items()) == list(other.items())
+    def __repr__(self) -> str:
+        return f"ScoreTable({len(self)} users)"
+def _mix64(x: int) -> int:
+    # splitmix64 finalizer: stable across processes, unlike hash()
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+class CreditedMembers:
+    # Members who already earned their inviter a point in this contest, so a
+    # member can be credited at most once however often they leave and come
+    # back. An exact set until it holds CREDITED_EXACT_LIMIT ids, then folded
+    # into a Bloom filter sized for CREDITED_BLOOM_CAPACITY at 1% error:
+    # lookups stay O(1) and memory stops growing, at the price of a rare new
+    # member wrongly treated as already credited.
+    __slots__ = ("exact", "bits", "hashes", "count")
+    def __init__(self):
+        self.exact = set()
+        self.bits: Optional[bytearray] = None
+        self.hashes = 0
+        self.count = 0
+    def __len__(self) -> int:
+        return self.count
+    def _positions(self, member_id: int):
+        h = _mix64(member_id & MASK64)
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        size = len(self.bits) << 3
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+    def __contains__(self, member_id: int) -> bool:
+        if self.bits is None:
+            return member_id in self.exact
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(member_id))
+    def add(self, member_id: int) -> bool:
+        # True if the member was not credited before
+        if member_id in self:
+            return False
+        self.count += 1
+        if self.bits is None:
+            self.exact.add(member_id)
+            if len(self.exact) > CREDITED_EXACT_LIMIT:
+                self._spill()
+            return True
+        bits = self.bits
+        for pos in self._positions(member_id):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        return True
+    def _spill(self):
+        capacity = max(CREDITED_BLOOM_CAPACITY, len(self.exact))
+        size = math.ceil(-capacity * math.log(CREDITED_BLOOM_ERROR) / math.log(2) ** 2)
+        self.bits = bytearray((size + 7) >> 3)
+        self.hashes = max(1, round((len(self.bits) << 3) / capacity * math.log(2)))
+        exact, self.exact = self.exact, set()
+        bits = self.bits
+        for member_id in exact:
+            for pos in self._positions(member_id):
+                bits[pos >> 3] |= 1 << (pos & 7)
+    def update(self, member_ids: Iterable[int]):
+        for member_id in member_ids:
+            self.add(int(member_id))
+    def to_json(self) -> Dict:
+        if self.bits is None:
+            return {"ids": _pack(array("q", sorted(self.exact)), delta=True)}
+        return {
+            "bloom": base64.b64encode(zlib.compress(bytes(self.bits), 1)).decode("ascii"),
+            "hashes": self.hashes,
+            "count": self.count,
+        }
+    @classmethod
+    def from_json(cls, data) -> "CreditedMembers":
+        if isinstance(data, CreditedMembers):
+            return data
+        members = cls()
+        if not data:
+            return members
+        if "bloom" in data:
+            members.bits = bytearray(zlib.decompress(base64.b64decode(data["bloom"])))
+            members.hashes = data["hashes"]
+            members.count = data["count"]
+        else:
+            members.exact = set(_unpack(data["ids"], delta=True))
+            members.count = len(members.exact)
+        return members
+    def __repr__(self) -> str:
+        kind = "exact" if self.bits is None else "bloom"
+        return f"CreditedMembers({self.count} members, {kind})"
+def encode_json(value):
+    # json.dumps default= hook for chat states holding compact tables
+    if isinstance(value, (ScoreTable, CreditedMembers)):
+        return value.to_json()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
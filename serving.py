@@ -0,0 +1,32 @@
+import os
+from dotenv import load_dotenv
+from telegram import Update
+from telegram.ext import Application
+load_dotenv()
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+def run_application(app: Application):
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            # without it PTB would register the listen address with Telegram
+            raise RuntimeError("WEBHOOK_URL not set in environment")
+        if not WEBHOOK_SECRET:
+            raise RuntimeError("WEBHOOK_SECRET not set in environment")
+        # Updates POSTed to WEBHOOK_PATH without the matching
+        # X-Telegram-Bot-Api-Secret-Token header are rejected with 403
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
@@ -0,0 +1,197 @@
+import os
+import re
+import sys
+import json
+import bisect
+import signal
+import asyncio
+import hashlib
+import argparse
+import multiprocessing
+from typing import Dict, List
+from dotenv import load_dotenv
+from telegram import Update
+from telegram.ext import Application, ApplicationBuilder, ContextTypes, TypeHandler
+from serving import run_application
+from metrics import METRICS_ENABLED, METRICS_PORT
+from storage import JsonStorage, dump_chat, write_json_atomic
+load_dotenv()
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL")
+STATE_FILE = os.getenv("STATE_FILE", "contest_state.json")
+EVENT_LOG_FILE = os.getenv("EVENT_LOG_FILE", "contest_events.log")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+API_GLOBAL_RATE = float(os.getenv("API_GLOBAL_RATE", "30"))
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", str(os.cpu_count() or 1)))
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+class HashRing:
+    # Consistent hashing of chat ids onto worker indexes; each worker owns many
+    # virtual points so chats spread evenly and few move when N changes.
+    def __init__(self, nodes: int, replicas: int = 64):
+        points = sorted((_hash(f"shard-{node}-{i}"), node) for node in range(nodes) for i in range(replicas))
+        self.hashes = [h for h, _ in points]
+        self.nodes = [node for _, node in points]
+    def node_for(self, chat_id) -> int:
+        i = bisect.bisect(self.hashes, _hash(str(chat_id)))
+        return self.nodes[i % len(self.nodes)]
+def shard_path(path: str, index: int) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext}"
+def shard_indexes() -> List[int]:
+    # indexes of the shard snapshots and logs on disk
+    indexes = set()
+    for path in (STATE_FILE, EVENT_LOG_FILE):
+        root, ext = os.path.splitext(path)
+        pattern = re.compile(re.escape(os.path.basename(root)) + r"\.shard(\d+)" + re.escape(ext) + "$")
+        for name in os.listdir(os.path.dirname(root) or "."):
+            match = pattern.match(name)
+            if match:
+                indexes.add(int(match.group(1)))
+    return sorted(indexes)
+def seed_shards(ring: HashRing, workers: int):
+    # Split an existing single-process JSON state into per-worker files once,
+    # and move chats between the shards when the worker count changes. The
+    # count is recorded next to the shards; every shard snapshot is rewritten
+    # with its log's seq, so the log is not replayed over it again, and a
+    # crash part way through only leaves chats in two shards until the rerun.
+    count_path = os.path.splitext(STATE_FILE)[0] + ".shards"
+    if os.path.exists(count_path):
+        with open(count_path, "r", encoding="utf-8") as f:
+            if int(f.read()) == workers:
+                return
+    indexes = shard_indexes()
+    if indexes:
+        sources = [(i, shard_path(STATE_FILE, i), shard_path(EVENT_LOG_FILE, i)) for i in indexes]
+    elif os.path.exists(STATE_FILE):
+        sources = [(None, STATE_FILE, EVENT_LOG_FILE)]
+    else:
+        sources = []
+    shards: List[Dict] = [{} for _ in range(workers)]
+    archives: List[Dict] = [{} for _ in range(workers)]
+    seqs: Dict[int, int] = {}
+    for index, path, log_path in sources:
+        storage = JsonStorage(path, log_path)
+        state = storage.load_chats(lazy=False)
+        storage.close()
+        if index is not None:
+            seqs[index] = storage.log.seq
+        for key, cs in state.items():
+            shards[ring.node_for(key)][key] = cs
+        if os.path.exists(storage.archive_path):
+            with open(storage.archive_path, "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn last line
+                    archives[ring.node_for(record["chat"])][(record["chat"], record["end_ts"])] = line
+    for index, shard in enumerate(shards):
+        path = shard_path(STATE_FILE, index)
+        items = [(key, dump_chat(cs)) for key, cs in shard.items()]
+        write_json_atomic(path, [("_seq", str(seqs.get(index, 0)))] + items)
+        archive_path = JsonStorage(path, shard_path(EVENT_LOG_FILE, index)).archive_path
+        with open(archive_path + ".tmp", "wb") as f:
+            f.writelines(archives[index].values())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(archive_path + ".tmp", archive_path)
+    for index in indexes:
+        if index >= workers:
+            storage = JsonStorage(shard_path(STATE_FILE, index), shard_path(EVENT_LOG_FILE, index))
+            for path in (storage.path, storage.log.path, storage.log.rotated_path, storage.archive_path, storage.profiles_path):
+                if os.path.exists(path):
+                    os.remove(path)
+    with open(count_path, "w", encoding="utf-8") as f:
+        f.write(str(workers))
+def worker_env(index: int, workers: int) -> Dict[str, str]:
+    env = {
+        "API_GLOBAL_RATE": str(API_GLOBAL_RATE / workers),
+        # workers restore only the chats routed to them
+        "SHARD_INDEX": str(index),
+        "SHARD_COUNT": str(workers),
+    }
+    if STORAGE_BACKEND == "json":
+        # JSON state is one file per worker; SQLite is shared (WAL allows it)
+        env["STATE_FILE"] = shard_path(STATE_FILE, index)
+        env["EVENT_LOG_FILE"] = shard_path(EVENT_LOG_FILE, index)
+    if METRICS_ENABLED:
+        # each worker serves its own scrape endpoint on consecutive ports
+        env["METRICS_PORT"] = str(METRICS_PORT + index)
+    return env
+async def serve_worker(inbox):
+    import main
+    app = main.build_application(ApplicationBuilder().updater(None))
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        # Ctrl+C and a stop of the whole process group reach workers directly;
+        # stop as the front would, after the updates already queued
+        try:
+            loop.add_signal_handler(sig, inbox.put, None)
+        except NotImplementedError:
+            pass
+    async with app:
+        await main.on_startup(app)
+        await app.start()
+        try:
+            while True:
+                data = await loop.run_in_executor(None, inbox.get)
+                if data is None:
+                    break
+                await app.update_queue.put(Update.de_json(data, app.bot))
+        finally:
+            await app.stop()
+            await main.on_shutdown(app)
+def run_worker(inbox):
+    asyncio.run(serve_worker(inbox))
+def start_workers(workers: int):
+    context = multiprocessing.get_context("spawn")
+    inboxes, processes = [], []
+    for index in range(workers):
+        inbox = context.Queue()
+        process = context.Process(target=run_worker, args=(inbox,), name=f"shard-{index}")
+        # spawned children read their configuration from the inherited env
+        saved = dict(os.environ)
+        os.environ.update(worker_env(index, workers))
+        try:
+            process.start()
+        finally:
+            os.environ.clear()
+            os.environ.update(saved)
+        inboxes.append(inbox)
+        processes.append(process)
+    return inboxes, processes
+def build_front(ring: HashRing, inboxes: List, processes: List) -> Application:
+    async def forward_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # one worker per chat keeps each chat's updates in arrival order
+        if update.effective_chat:
+            key = update.effective_chat.id
+        elif update.effective_user:
+            key = update.effective_user.id
+        else:
+            key = 0
+        inboxes[ring.node_for(key)].put(update.to_dict())
+    async def stop_workers(app: Application):
+        for inbox in inboxes:
+            inbox.put(None)
+        for process in processes:
+            await asyncio.to_thread(process.join)
+    builder = ApplicationBuilder()
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL)
+    app = builder.token(BOT_TOKEN).post_shutdown(stop_workers).build()
+    app.add_handler(TypeHandler(Update, forward_update))
+    return app
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the bot as a routing front process plus N chat-sharded workers.")
+    parser.add_argument("--workers", type=int, default=SHARD_WORKERS)
+    args = parser.parse_args(argv)
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN not set in environment")
+    ring = HashRing(args.workers)
+    if STORAGE_BACKEND == "json":
+        seed_shards(ring, args.workers)
+    inboxes, processes = start_workers(args.workers)
+    run_application(build_front(ring, inboxes, processes))
+if __name__ == "__main__":
+    main(sys.argv[1:])
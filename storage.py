@@ -0,0 +1,834 @@
+import os
+import json
+import time
+import heapq
+import sqlite3
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from metrics import STATE_FLUSH_BYTES, STATE_FLUSH_SECONDS
+from scores import CreditedMembers, ScoreTable, encode_json
+# user_links is rebuilt from the links table on load rather than stored
+CHAT_COLUMNS = ("active", "end_ts", "pinned_message_id", "scores", "links", "user_links", "credited")
+LINK_COLUMNS = ("creator_id", "revoked")
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id INTEGER PRIMARY KEY,
+    active INTEGER NOT NULL DEFAULT 0,
+    end_ts INTEGER NOT NULL DEFAULT 0,
+    pinned_message_id INTEGER,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS chats_active ON chats (active, end_ts);
+CREATE TABLE IF NOT EXISTS scores (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    score INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS scores_rank ON scores (chat_id, score DESC, user_id);
+CREATE TABLE IF NOT EXISTS links (
+    chat_id INTEGER NOT NULL,
+    invite_link TEXT NOT NULL,
+    creator_id INTEGER,
+    revoked INTEGER NOT NULL DEFAULT 0,
+    extra TEXT NOT NULL DEFAULT '{}',
+    PRIMARY KEY (chat_id, invite_link)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS links_creator ON links (chat_id, creator_id);
+CREATE TABLE IF NOT EXISTS credited (
+    chat_id INTEGER NOT NULL,
+    member_id INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, member_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS archive (
+    chat_id INTEGER NOT NULL,
+    end_ts INTEGER NOT NULL,
+    archived_ts INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (chat_id, end_ts)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS archive_end ON archive (end_ts);
+CREATE TABLE IF NOT EXISTS profiles (
+    user_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    seen INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS profiles_seen ON profiles (seen);
+"""
+def new_chat_state() -> Dict:
+    return {
+        "active": False,
+        "end_ts": 0,
+        "scores": ScoreTable(),
+        "pinned_message_id": None,
+        "links": {},
+        "user_links": {},
+        "credited": CreditedMembers(),
+    }
+def dump_chat(cs: Dict) -> str:
+    return json.dumps(cs, ensure_ascii=False, default=encode_json)
+def decode_chat(cs: Dict) -> Dict:
+    cs["scores"] = ScoreTable.from_json(cs.get("scores"))
+    cs["credited"] = CreditedMembers.from_json(cs.get("credited"))
+    return cs
+HOUR = 3600
+DAY = 86400
+ARCHIVE_TOP = 10
+def count_joins(cs: Dict, ts: int, joins: int):
+    # per-hour join counts of the running contest, keyed by the hour's start
+    hourly = cs.setdefault("joins_hourly", {})
+    hour = str(ts - ts % HOUR)
+    hourly[hour] = hourly.get(hour, 0) + joins
+def rollup(hourly: Dict[str, int], bucket: int) -> List[List[int]]:
+    totals: Dict[int, int] = {}
+    for hour, joins in hourly.items():
+        ts = int(hour)
+        ts -= ts % bucket
+        totals[ts] = totals.get(ts, 0) + joins
+    return [[ts, joins] for ts, joins in sorted(totals.items())]
+def write_json_atomic(path: str, items: Iterable[Tuple[str, str]]) -> int:
+    # items are (chat_key, serialized chat state); written to a temp file and
+    # renamed over path so a crash never leaves a truncated file behind.
+    # Returns the number of bytes written.
+    tmp_path = path + ".tmp"
+    size = write_json(tmp_path, items)
+    os.replace(tmp_path, path)
+    return size
+def write_json(path: str, items: Iterable[Tuple[str, object]], offsets: Optional[Dict] = None) -> int:
+    # One item per line; data may be str or already encoded bytes. offsets,
+    # if given, receives key -> (byte offset, length) of each item's data.
+    pos = 0
+    with open(path, "wb") as f:
+        sep = b"{"
+        for key, data in items:
+            head = sep + json.dumps(key).encode() + b": "
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            f.write(head)
+            f.write(data)
+            if offsets is not None:
+                offsets[key] = (pos + len(head), len(data))
+            pos += len(head) + len(data)
+            sep = b",\n"
+        if sep == b"{":
+            f.write(sep)
+        f.write(b"}\n")
+        f.flush()
+        os.fsync(f.fileno())
+        return os.fstat(f.fileno()).st_size
+def apply_event(state: Dict, event: Dict):
+    cs = state.get(event["chat"])
+    if cs is None:
+        cs = state[event["chat"]] = new_chat_state()
+    kind = event["ev"]
+    if kind == "credit":
+        cs["scores"][int(event["user"])] = event["score"]
+    elif kind == "credits":
+        cs["scores"].update(event["scores"])
+        if event.get("joins"):
+            count_joins(cs, event["ts"], event["joins"])
+        if event.get("members"):
+            cs["credited"].update(event["members"])
+    elif kind == "link":
+        cs["links"][event["link"]] = event["meta"]
+        if event["meta"].get("creator_id") is not None:
+            cs.setdefault("user_links", {})[str(event["meta"]["creator_id"])] = event["link"]
+    elif kind == "start":
+        cs["active"] = True
+        cs["end_ts"] = event["end_ts"]
+        cs["start_ts"] = event["ts"]
+        cs["scores"] = ScoreTable()
+        cs["links"] = {}
+        cs["user_links"] = {}
+        cs["joins_hourly"] = {}
+        cs["credited"] = CreditedMembers()
+    elif kind == "end":
+        cs["active"] = False
+        cs["end_ts"] = event.get("end_ts", cs["end_ts"])
+    elif kind == "archive":
+        cs["scores"] = ScoreTable()
+        cs["links"] = {}
+        cs["user_links"] = {}
+        cs["joins_hourly"] = {}
+        cs["credited"] = CreditedMembers()
+class EventLog:
+    # Append-only JSON-lines log of credits, link changes and contest
+    # start/end. Every event
+    # carries a sequence number; a snapshot records the last seq it includes,
+    # so recovery replays only the tail. rotate() moves the live log aside
+    # before a snapshot is written, and discard_rotated() drops it afterwards.
+    def __init__(self, path: str):
+        self.path = path
+        self.rotated_path = path + ".old"
+        self.seq = 0
+        self.f = None
+    def replay(self, state: Dict, after_seq: int, load=None):
+        # load(key) supplies chats that are not in state yet
+        self.seq = after_seq
+        for path in (self.rotated_path, self.path):
+            if not os.path.exists(path):
+                continue
+            good = 0
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("no newline")
+                        event = json.loads(line)
+                    except ValueError:
+                        # torn write from a crash; nothing valid can follow it
+                        break
+                    good += len(line)
+                    if event["seq"] > after_seq:
+                        if load is not None and event["chat"] not in state:
+                            cs = load(event["chat"])
+                            if cs is not None:
+                                state[event["chat"]] = cs
+                        apply_event(state, event)
+                        self.seq = max(self.seq, event["seq"])
+            if good < os.path.getsize(path):
+                # cut the torn line off, or the next append would be glued to it
+                with open(path, "r+b") as f:
+                    f.truncate(good)
+    def open(self):
+        self.f = open(self.path, "a", encoding="utf-8")
+    def append(self, event: Dict):
+        self.seq += 1
+        event["seq"] = self.seq
+        event["ts"] = int(time.time())
+        self.f.write(json.dumps(event, ensure_ascii=False) + "\n")
+        self.f.flush()
+    def rotate(self):
+        if os.path.exists(self.rotated_path):
+            # the previous snapshot failed; keep its log until one succeeds
+            return
+        self.f.close()
+        os.replace(self.path, self.rotated_path)
+        self.open()
+    def discard_rotated(self):
+        if os.path.exists(self.rotated_path):
+            os.remove(self.rotated_path)
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+class JsonStorage:
+    # Whole-file JSON snapshot plus an append-only event log. Credits and
+    # contest start/end are appended to the log as they happen; flush()
+    # re-serializes only the dirty chats, writes the snapshot off the event
+    # loop and compacts the log. The snapshot holds one chat per line and
+    # lists the chats with pending work under "_resident"; load_chats()
+    # decodes only those (and chats the log touches) and indexes where every
+    # other chat's line sits, so load_chat() reads it from the file on demand
+    # and a flush copies unchanged chats across byte for byte. Chats evicted
+    # with unsaved changes wait in fragments until the next flush. Finished
+    # contests are appended to a JSON-lines archive next to the snapshot;
+    # the byte offset of every record is indexed per chat on first read, so
+    # history queries seek straight to a chat's records. Display names are
+    # appended to a JSON-lines file, rewritten from the cache once it holds
+    # twice as many lines as names.
+    def __init__(self, path: str, log_path: str):
+        self.path = path
+        self.archive_path = os.path.splitext(path)[0] + "_archive.jsonl"
+        self.profiles_path = os.path.splitext(path)[0] + "_profiles.jsonl"
+        self.profile_lines = 0
+        self.log = EventLog(log_path)
+        self.dirty = set()
+        self.fragments: Dict[str, str] = {}
+        # fragments and dirty chats the running flush writes, until it lands
+        self.writing: Dict[str, str] = {}
+        # chat key -> (offset, length) of its data in the snapshot file
+        self.offsets: Dict[str, Tuple[int, int]] = {}
+        self.snapshot = None
+        # evicted chats that still have pending work
+        self.parked = set()
+        # chat key -> {end_ts: offset of its latest archive line}
+        self.archive_index: Optional[Dict[str, Dict[int, int]]] = None
+        self.lock = asyncio.Lock()
+    def load_chats(self, lazy: bool = True) -> Dict:
+        state = {}
+        snapshot_seq, resident = 0, None
+        if os.path.exists(self.path):
+            snapshot_seq, resident = self.index_snapshot()
+            if resident is None:
+                # written before snapshots were indexed: decode it all, once
+                with open(self.path, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+                snapshot_seq = state.pop("_seq", 0)
+                for cs in state.values():
+                    decode_chat(cs)
+                self.offsets = {}
+                self.dirty.update(state)
+            else:
+                self.snapshot = open(self.path, "rb")
+                state = {key: self.load_chat(key) for key in resident if key in self.offsets}
+        self.log.replay(state, snapshot_seq, self.load_chat)
+        self.log.open()
+        if not lazy:
+            for key in self.offsets:
+                if key not in state:
+                    state[key] = self.load_chat(key)
+            self.dirty.update(state)
+            return state
+        chats = {}
+        for key, cs in state.items():
+            self.dirty.add(key)
+            if needs_residence(cs):
+                chats[key] = cs
+            else:
+                self.fragments[key] = dump_chat(cs)
+        return chats
+    def index_snapshot(self) -> Tuple[int, Optional[List[str]]]:
+        # (seq, resident keys), filling self.offsets without decoding any chat;
+        # resident is None for a snapshot not laid out one chat per line
+        offsets: Dict[str, Tuple[int, int]] = {}
+        seq, resident = 0, None
+        pos = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                start, body = pos, line.rstrip(b"\r\n")
+                pos += len(line)
+                if start == 0:
+                    if not body.startswith(b"{"):
+                        return 0, None
+                    body, start = body[1:], 1
+                if body.endswith(b","):
+                    body = body[:-1]
+                elif body.endswith(b"}"):
+                    body = body[:-1]  # the last line also closes the object
+                if not body:
+                    continue
+                sep = body.find(b'": ')
+                if not body.startswith(b'"') or sep < 0:
+                    return 0, None
+                key = json.loads(body[:sep + 1])
+                if key == "_seq":
+                    seq = int(body[sep + 3:])
+                elif key == "_resident":
+                    resident = json.loads(body[sep + 3:])
+                else:
+                    offsets[key] = (start + sep + 3, len(body) - sep - 3)
+        self.offsets = offsets
+        return seq, resident
+    def load_chat(self, chat_id) -> Optional[Dict]:
+        key = str(chat_id)
+        data = self.fragments.get(key)
+        if data is None:
+            data = self.writing.get(key)
+        if data is None and key in self.offsets:
+            start, length = self.offsets[key]
+            self.snapshot.seek(start)
+            data = self.snapshot.read(length)
+        return decode_chat(json.loads(data)) if data is not None else None
+    def evict(self, chat_id, cs: Dict):
+        key = str(chat_id)
+        if key in self.dirty:
+            self.fragments[key] = dump_chat(cs)
+        if needs_residence(cs):
+            self.parked.add(key)
+        else:
+            self.parked.discard(key)
+    def active_chat_ids(self, state: Dict) -> List[str]:
+        return [key for key, cs in state.items() if cs.get("active")]
+    def pending_delete_chat_ids(self, state: Dict) -> List[str]:
+        return [key for key, cs in state.items() if cs.get("delete_queue")]
+    def pending_finish_chat_ids(self, state: Dict) -> List[str]:
+        return [key for key, cs in state.items() if needs_finish(cs)]
+    def mark_dirty(self, chat_id):
+        self.dirty.add(str(chat_id))
+    def record_scores(self, chat_id, scores: Dict[int, int], joins: int = 0, members: List[int] = ()):
+        event = {"ev": "credits", "chat": str(chat_id), "scores": scores, "joins": joins}
+        if members:
+            event["members"] = list(members)
+        self.log.append(event)
+        self.dirty.add(str(chat_id))
+    def record_link(self, chat_id, link_url: str, meta: Dict):
+        self.log.append({"ev": "link", "chat": str(chat_id), "link": link_url, "meta": meta})
+        self.dirty.add(str(chat_id))
+    def record_start(self, chat_id, end_ts: int):
+        self.log.append({"ev": "start", "chat": str(chat_id), "end_ts": end_ts})
+        self.dirty.add(str(chat_id))
+    def record_end(self, chat_id, end_ts: int):
+        self.log.append({"ev": "end", "chat": str(chat_id), "end_ts": end_ts})
+        self.dirty.add(str(chat_id))
+    def archive_contest(self, chat_id, cs: Dict):
+        # the archive line is written before the log event that clears the
+        # contest, so a crash in between only risks a duplicate archive line
+        record = archive_record(str(chat_id), cs)
+        with open(self.archive_path, "ab") as f:
+            offset = f.tell()
+            f.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if self.archive_index is not None:
+            self.archive_index.setdefault(record["chat"], {})[record["end_ts"]] = offset
+        self.log.append({"ev": "archive", "chat": str(chat_id)})
+        self.dirty.add(str(chat_id))
+    def load_profiles(self, limit: int) -> List[Tuple[int, str]]:
+        # (user id, escaped name), least recently seen first
+        names: "OrderedDict[int, str]" = OrderedDict()
+        lines = 0
+        if os.path.exists(self.profiles_path):
+            with open(self.profiles_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        user_id, name = json.loads(line)
+                    except ValueError:
+                        break  # torn last line
+                    names[user_id] = name
+                    names.move_to_end(user_id)
+                    lines += 1
+        items = list(names.items())[-limit:] if limit > 0 else []
+        if lines > len(items):
+            self.rewrite_profiles(items)
+        self.profile_lines = len(items)
+        return items
+    def record_profiles(self, changes: Dict[int, str], profiles: Iterable[Tuple[int, str]]):
+        with open(self.profiles_path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps([user_id, name], ensure_ascii=False) + "\n" for user_id, name in changes.items())
+        self.profile_lines += len(changes)
+        items = list(profiles)
+        if self.profile_lines > 2 * max(len(items), 1000):
+            self.rewrite_profiles(items)
+            self.profile_lines = len(items)
+    def rewrite_profiles(self, items: List[Tuple[int, str]]):
+        tmp_path = self.profiles_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps([user_id, name], ensure_ascii=False) + "\n" for user_id, name in items)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.profiles_path)
+    def index_archive(self) -> Dict[str, Dict[int, int]]:
+        if self.archive_index is None:
+            index: Dict[str, Dict[int, int]] = {}
+            if os.path.exists(self.archive_path):
+                with open(self.archive_path, "rb") as f:
+                    offset = 0
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            break  # torn last line
+                        index.setdefault(record["chat"], {})[record["end_ts"]] = offset
+                        offset += len(line)
+            self.archive_index = index
+        return self.archive_index
+    def archived_contests(self, chat_id=None, since: int = 0) -> List[Dict]:
+        # archived contests that ended at or after since, oldest first
+        index = self.index_archive()
+        keys = [str(chat_id)] if chat_id is not None else list(index)
+        offsets = sorted(
+            (end_ts, offset)
+            for key in keys
+            for end_ts, offset in index.get(key, {}).items()
+            if end_ts >= since
+        )
+        records = []
+        if offsets:
+            with open(self.archive_path, "rb") as f:
+                for _, offset in offsets:
+                    f.seek(offset)
+                    records.append(json.loads(f.readline()))
+        return records
+    async def flush(self, state: Dict):
+        async with self.lock:
+            if not self.dirty:
+                return
+            writing = self.fragments
+            for key in self.dirty:
+                if key in state:
+                    writing[key] = dump_chat(state[key])
+            self.dirty.clear()
+            self.fragments, self.writing = {}, writing
+            resident = [key for key, cs in state.items() if needs_residence(cs)]
+            resident += [key for key in self.parked if key not in state]
+            copied = [(key, span) for key, span in self.offsets.items() if key not in writing]
+            # read here: events appended after rotate() belong to the next snapshot
+            meta = [("_seq", str(self.log.seq)), ("_resident", json.dumps(resident))]
+            def items():
+                yield from meta
+                yield from writing.items()
+                if copied:
+                    with open(self.path, "rb") as f:
+                        for key, (start, length) in copied:
+                            f.seek(start)
+                            yield key, f.read(length)
+            self.log.rotate()
+            tmp_path = self.path + ".tmp"
+            offsets: Dict[str, Tuple[int, int]] = {}
+            started = time.monotonic()
+            try:
+                size = await asyncio.to_thread(write_json, tmp_path, items(), offsets)
+            except BaseException:
+                # keep the unsaved chats for the next attempt
+                self.fragments = {**writing, **self.fragments}
+                self.dirty.update(writing)
+                self.writing = {}
+                raise
+            # swapped in one step, so no load_chat() reads new offsets from the old file
+            if self.snapshot:
+                self.snapshot.close()
+            os.replace(tmp_path, self.path)
+            self.snapshot = open(self.path, "rb")
+            for key, _ in meta:
+                del offsets[key]
+            self.offsets, self.writing = offsets, {}
+            STATE_FLUSH_SECONDS.observe("json", value=time.monotonic() - started)
+            STATE_FLUSH_BYTES.inc("json", amount=size)
+            self.log.discard_rotated()
+    def close(self):
+        self.log.close()
+        if self.snapshot:
+            self.snapshot.close()
+            self.snapshot = None
+class SqliteStorage:
+    # One row per chat, score, invite link and credited member in a WAL-mode
+    # database. Chats are loaded on first access; pending upserts are batched
+    # into one transaction per flush() and executed off the event loop. Reads
+    # made from the event loop use a second connection, which WAL lets run
+    # alongside the flush's write transaction; until that commits, the chats
+    # and archive records it carries are served from memory instead.
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SQLITE_SCHEMA)
+        self.db_lock = threading.Lock()
+        self.reader = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.reader.execute("PRAGMA query_only=ON")
+        self.read_lock = threading.Lock()
+        self.lock = asyncio.Lock()
+        self.dirty = set()
+        self.resets = set()
+        self.scores: Dict[Tuple[str, int], int] = {}
+        self.links: Dict[Tuple[str, str], Dict] = {}
+        self.members: Set[Tuple[str, int]] = set()
+        # evicted chats with unsaved changes, until their flush has committed
+        self.evicted: Dict[str, Dict] = {}
+        # every chat the running flush writes, until its transaction commits
+        self.writing: Dict[str, Dict] = {}
+        self.archives: List[Tuple] = []
+        self.archiving: List[Tuple] = []
+        self.profiles: Dict[int, Tuple[str, int]] = {}
+    def is_empty(self) -> bool:
+        with self.read_lock:
+            return self.reader.execute("SELECT 1 FROM chats LIMIT 1").fetchone() is None
+    def load_chats(self) -> Dict:
+        return {}
+    def load_chat(self, chat_id) -> Optional[Dict]:
+        key = str(chat_id)
+        cs = self.evicted.pop(key, None) or self.writing.get(key)
+        if cs is not None:
+            self.dirty.add(key)
+            return cs
+        with self.read_lock:
+            # one read transaction, so all three see the same commit
+            self.reader.execute("BEGIN")
+            try:
+                row = self.reader.execute(
+                    "SELECT active, end_ts, pinned_message_id, extra FROM chats WHERE chat_id = ?",
+                    (int(chat_id),),
+                ).fetchone()
+                if row is None:
+                    return None
+                score_rows = self.reader.execute(
+                    "SELECT user_id, score FROM scores WHERE chat_id = ? ORDER BY user_id", (int(chat_id),)
+                ).fetchall()
+                link_rows = self.reader.execute(
+                    "SELECT invite_link, creator_id, revoked, extra FROM links WHERE chat_id = ?",
+                    (int(chat_id),),
+                ).fetchall()
+                member_rows = self.reader.execute(
+                    "SELECT member_id FROM credited WHERE chat_id = ?", (int(chat_id),)
+                ).fetchall()
+            finally:
+                self.reader.execute("COMMIT")
+        cs = json.loads(row[3])
+        cs["active"] = bool(row[0])
+        cs["end_ts"] = row[1]
+        cs["pinned_message_id"] = row[2]
+        cs["scores"] = ScoreTable.from_pairs(score_rows)
+        # the set is rebuilt from the rows, and spills again past its limit
+        cs["credited"] = CreditedMembers()
+        cs["credited"].update(member_id for (member_id,) in member_rows)
+        links, user_links = {}, {}
+        for link_url, creator_id, revoked, extra in link_rows:
+            meta = json.loads(extra)
+            meta["creator_id"] = creator_id
+            meta["revoked"] = bool(revoked)
+            links[link_url] = meta
+            if creator_id is not None:
+                user_links[str(creator_id)] = link_url
+        cs["links"] = links
+        cs["user_links"] = user_links
+        return cs
+    def active_chat_ids(self, state: Dict) -> List[str]:
+        with self.read_lock:
+            rows = self.reader.execute("SELECT chat_id FROM chats WHERE active = 1").fetchall()
+        keys = {str(chat_id) for (chat_id,) in rows if str(chat_id) not in state}
+        keys.update(key for key, cs in state.items() if cs.get("active"))
+        return sorted(keys)
+    def pending_delete_chat_ids(self, state: Dict) -> List[str]:
+        with self.read_lock:
+            rows = self.reader.execute(
+                "SELECT chat_id FROM chats WHERE json_extract(extra, '$.delete_queue[0]') IS NOT NULL"
+            ).fetchall()
+        keys = {str(chat_id) for (chat_id,) in rows if str(chat_id) not in state}
+        keys.update(key for key, cs in state.items() if cs.get("delete_queue"))
+        return sorted(keys)
+    def pending_finish_chat_ids(self, state: Dict) -> List[str]:
+        with self.read_lock:
+            rows = self.reader.execute(
+                "SELECT chat_id FROM chats WHERE active = 0 AND ("
+                "EXISTS (SELECT 1 FROM scores WHERE scores.chat_id = chats.chat_id) OR "
+                "EXISTS (SELECT 1 FROM links WHERE links.chat_id = chats.chat_id))"
+            ).fetchall()
+        keys = {str(chat_id) for (chat_id,) in rows if str(chat_id) not in state}
+        keys.update(key for key, cs in state.items() if needs_finish(cs))
+        return sorted(keys)
+    def mark_dirty(self, chat_id):
+        self.dirty.add(str(chat_id))
+    def evict(self, chat_id, cs: Dict):
+        key = str(chat_id)
+        if key in self.dirty or key in self.writing:
+            self.dirty.discard(key)
+            self.evicted[key] = cs
+    def record_scores(self, chat_id, scores: Dict[int, int], joins: int = 0, members: List[int] = ()):
+        key = str(chat_id)
+        for user_id, score in scores.items():
+            self.scores[(key, int(user_id))] = score
+        self.members.update((key, int(member_id)) for member_id in members)
+        if joins:
+            # hourly join counts live in the chat row
+            self.dirty.add(key)
+    def record_link(self, chat_id, link_url: str, meta: Dict):
+        self.links[(str(chat_id), link_url)] = dict(meta)
+    def record_start(self, chat_id, end_ts: int):
+        key = str(chat_id)
+        self.scores = {k: v for k, v in self.scores.items() if k[0] != key}
+        self.links = {k: v for k, v in self.links.items() if k[0] != key}
+        self.members = {k for k in self.members if k[0] != key}
+        self.resets.add(key)
+        self.dirty.add(key)
+    def record_end(self, chat_id, end_ts: int):
+        self.dirty.add(str(chat_id))
+    def archive_contest(self, chat_id, cs: Dict):
+        key = str(chat_id)
+        record = archive_record(key, cs)
+        self.archives.append((int(key), record["end_ts"], record["archived_ts"], json.dumps(record, ensure_ascii=False)))
+        self.scores = {k: v for k, v in self.scores.items() if k[0] != key}
+        self.links = {k: v for k, v in self.links.items() if k[0] != key}
+        self.members = {k for k in self.members if k[0] != key}
+        self.resets.add(key)
+        self.dirty.add(key)
+    def load_profiles(self, limit: int) -> List[Tuple[int, str]]:
+        with self.db_lock:
+            # drop names that fell out of the cache last run
+            self.conn.execute(
+                "DELETE FROM profiles WHERE seen < "
+                "(SELECT seen FROM profiles ORDER BY seen DESC LIMIT 1 OFFSET ?)",
+                (max(limit, 1) - 1,),
+            )
+            rows = self.conn.execute(
+                "SELECT user_id, name FROM profiles ORDER BY seen DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return rows[::-1]
+    def record_profiles(self, changes: Dict[int, str], profiles: Iterable[Tuple[int, str]]):
+        seen = time.time_ns()
+        for user_id, name in changes.items():
+            self.profiles[user_id] = (name, seen)
+            seen += 1
+    def archived_contests(self, chat_id=None, since: int = 0) -> List[Dict]:
+        with self.read_lock:
+            if chat_id is None:
+                rows = self.reader.execute(
+                    "SELECT data FROM archive WHERE end_ts >= ? ORDER BY end_ts", (since,)
+                ).fetchall()
+            else:
+                rows = self.reader.execute(
+                    "SELECT data FROM archive WHERE chat_id = ? AND end_ts >= ? ORDER BY end_ts",
+                    (int(chat_id), since),
+                ).fetchall()
+        records = {(r["chat"], r["end_ts"]): r for r in (json.loads(data) for (data,) in rows)}
+        # archived since the last committed flush
+        for row_chat, end_ts, _, data in self.archiving + self.archives:
+            if end_ts >= since and (chat_id is None or row_chat == int(chat_id)):
+                record = json.loads(data)
+                records[(record["chat"], end_ts)] = record
+        return sorted(records.values(), key=lambda r: r["end_ts"])
+    async def flush(self, state: Dict):
+        async with self.lock:
+            if not (self.dirty or self.scores or self.links or self.members or self.evicted or self.profiles):
+                return
+            writing = dict(self.evicted)
+            pending = self.dirty.union(
+                (c for c, _ in self.scores), (c for c, _ in self.links), (c for c, _ in self.members)
+            )
+            writing.update((key, state[key]) for key in pending if key in state)
+            chats = [chat_row(key, cs) for key, cs in self.evicted.items()]
+            chats += [chat_row(key, state[key]) for key in self.dirty if key in state]
+            archives = self.archives
+            resets = [(int(key),) for key in self.resets]
+            scores = [(int(c), u, s) for (c, u), s in self.scores.items()]
+            links = [link_row(c, url, meta) for (c, url), meta in self.links.items()]
+            members = [(int(c), m) for c, m in self.members]
+            profiles = [(user_id, name, seen) for user_id, (name, seen) in self.profiles.items()]
+            batch = (self.dirty, self.resets, self.scores, self.links, self.members, self.evicted, self.profiles)
+            self.dirty, self.resets, self.scores, self.links, self.members = set(), set(), {}, {}, set()
+            self.writing, self.evicted, self.archives, self.profiles = writing, {}, [], {}
+            self.archiving = archives
+            started = time.monotonic()
+            try:
+                await asyncio.to_thread(self.write, chats, resets, scores, links, archives, profiles, members)
+            except BaseException:
+                self.requeue(state, batch, archives)
+                raise
+            finally:
+                self.writing, self.archiving = {}, []
+            STATE_FLUSH_SECONDS.observe("sqlite", value=time.monotonic() - started)
+    def requeue(self, state: Dict, batch: Tuple, archives: List):
+        # A failed flush hands its work back, under whatever was queued while
+        # it ran: a chat reset since then drops its older score and link rows.
+        dirty, resets, scores, links, members, evicted, profiles = batch
+        self.scores = {k: v for k, v in scores.items() if k[0] not in self.resets} | self.scores
+        self.links = {k: v for k, v in links.items() if k[0] not in self.resets} | self.links
+        self.members |= {k for k in members if k[0] not in self.resets}
+        self.resets |= resets
+        self.archives = archives + self.archives
+        self.profiles = profiles | self.profiles
+        self.dirty |= {key for key in dirty if key in state}
+        for key, cs in evicted.items():
+            if key in state:
+                self.dirty.add(key)
+            else:
+                self.evicted.setdefault(key, cs)
+    def write(
+        self,
+        chats: List,
+        resets: List,
+        scores: List,
+        links: List,
+        archives: List = (),
+        profiles: List = (),
+        members: List = (),
+    ):
+        with self.db_lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO archive (chat_id, end_ts, archived_ts, data) VALUES (?, ?, ?, ?)",
+                    archives,
+                )
+                self.conn.executemany(
+                    "INSERT INTO chats (chat_id, active, end_ts, pinned_message_id, extra) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (chat_id) DO UPDATE SET active = excluded.active, end_ts = excluded.end_ts, "
+                    "pinned_message_id = excluded.pinned_message_id, extra = excluded.extra",
+                    chats,
+                )
+                self.conn.executemany("DELETE FROM scores WHERE chat_id = ?", resets)
+                self.conn.executemany("DELETE FROM links WHERE chat_id = ?", resets)
+                self.conn.executemany("DELETE FROM credited WHERE chat_id = ?", resets)
+                self.conn.executemany(
+                    "INSERT INTO scores (chat_id, user_id, score) VALUES (?, ?, ?) "
+                    "ON CONFLICT (chat_id, user_id) DO UPDATE SET score = excluded.score",
+                    scores,
+                )
+                self.conn.executemany(
+                    "INSERT INTO links (chat_id, invite_link, creator_id, revoked, extra) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (chat_id, invite_link) DO UPDATE SET creator_id = excluded.creator_id, "
+                    "revoked = excluded.revoked, extra = excluded.extra",
+                    links,
+                )
+                self.conn.executemany("INSERT OR IGNORE INTO credited (chat_id, member_id) VALUES (?, ?)", members)
+                self.conn.executemany(
+                    "INSERT INTO profiles (user_id, name, seen) VALUES (?, ?, ?) "
+                    "ON CONFLICT (user_id) DO UPDATE SET name = excluded.name, seen = excluded.seen",
+                    profiles,
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+    def import_state(self, state: Dict):
+        chats = [chat_row(key, cs) for key, cs in state.items()]
+        resets = [(int(key),) for key in state]
+        scores = [
+            (int(key), user_id, score)
+            for key, cs in state.items()
+            for user_id, score in ScoreTable.from_json(cs.get("scores")).items()
+        ]
+        links = [
+            link_row(key, link_url, meta)
+            for key, cs in state.items()
+            for link_url, meta in cs.get("links", {}).items()
+        ]
+        # a set already folded into a Bloom filter has no ids left to import
+        members = [
+            (int(key), member_id)
+            for key, cs in state.items()
+            for member_id in CreditedMembers.from_json(cs.get("credited")).exact
+        ]
+        self.write(chats, resets, scores, links, members=members)
+    def close(self):
+        with self.read_lock:
+            self.reader.close()
+        with self.db_lock:
+            self.conn.close()
+def needs_finish(cs: Dict) -> bool:
+    # an ended contest whose links are not all revoked or that is not archived yet
+    return not cs.get("active") and bool(cs.get("scores") or cs.get("links"))
+def needs_residence(cs: Dict) -> bool:
+    return bool(cs.get("active") or cs.get("delete_queue") or needs_finish(cs))
+def archive_record(key: str, cs: Dict) -> Dict:
+    # per-inviter totals plus the joins rolled up per hour and per day as
+    # [bucket start, joins] pairs; the raw credit events are not kept
+    links = cs.get("links", {})
+    scores = ScoreTable.from_json(cs.get("scores"))
+    hourly = cs.get("joins_hourly") or {}
+    top = heapq.nlargest(ARCHIVE_TOP, scores.items(), key=lambda kv: (kv[1], -kv[0]))
+    return {
+        "chat": key,
+        "start_ts": int(cs.get("start_ts") or 0),
+        "end_ts": int(cs.get("end_ts") or 0),
+        "archived_ts": int(time.time()),
+        "participants": len(scores),
+        "credited_members": len(cs.get("credited") or ()),
+        "joins": sum(hourly.values()),
+        "top": [[user_id, score] for user_id, score in top],
+        "hourly": rollup(hourly, HOUR),
+        "daily": rollup(hourly, DAY),
+        "scores": scores.to_json(),
+        "links": len(links),
+        "revoked": sum(1 for meta in links.values() if meta.get("revoked")),
+    }
+def chat_row(key: str, cs: Dict) -> Tuple:
+    extra = {k: v for k, v in cs.items() if k not in CHAT_COLUMNS}
+    return (
+        int(key),
+        int(bool(cs.get("active"))),
+        int(cs.get("end_ts") or 0),
+        cs.get("pinned_message_id"),
+        json.dumps(extra, ensure_ascii=False, default=encode_json),
+    )
+def link_row(key: str, link_url: str, meta: Dict) -> Tuple:
+    extra = {k: v for k, v in meta.items() if k not in LINK_COLUMNS}
+    return (
+        int(key),
+        link_url,
+        meta.get("creator_id"),
+        int(bool(meta.get("revoked"))),
+        json.dumps(extra, ensure_ascii=False),
+    )
+def migrate_json_to_sqlite(json_path: str, storage: SqliteStorage) -> int:
+    # One-shot import of a legacy contest_state.json into an empty database
+    if not os.path.exists(json_path) or not storage.is_empty():
+        return 0
+    with open(json_path, "r", encoding="utf-8") as f:
+        state = json.load(f)
+    state.pop("_seq", None)
+    state.pop("_resident", None)
+    storage.import_state(state)
+    return len(state)